@@ -0,0 +1,148 @@
+"""Vectorized decoding of many frames of one message into numpy columns.
+
+Each signal is compiled once from its cantools definition into a shift,
+mask, sign and scale over the 64 bit payload word, so a whole column is
+decoded with a handful of array operations instead of a Python call per
+frame. CanDecoder's DecodePlan uses the same columns on single frames,
+with Python ints instead of arrays, to decode only the subscribed signals.
+"""
+
+import struct
+from typing import Dict, List
+
+import numpy as np
+
+_WORD = np.uint64
+_NAN = float("nan")
+
+
+class _SignalColumn:
+    __slots__ = (
+        "name",
+        "little_endian",
+        "shift",
+        "mask",
+        "length",
+        "is_signed",
+        "is_float",
+        "scale",
+        "offset",
+        "multiplexer_signal",
+        "multiplexer_ids",
+    )
+
+    def __init__(self, sig):
+        self.name = sig.name
+        self.little_endian = sig.byte_order == "little_endian"
+        self.length = sig.length
+        if self.little_endian:
+            self.shift = sig.start
+        else:
+            # dbc big endian start bits count the msb in sawtooth order
+            msb = (sig.start // 8) * 8 + (7 - sig.start % 8)
+            self.shift = 64 - (msb + sig.length)
+        if self.shift < 0 or self.shift + self.length > 64:
+            raise ValueError(f"signal {sig.name} does not fit in 8 bytes")
+        self.mask = (1 << sig.length) - 1
+        self.is_signed = sig.is_signed
+        self.is_float = sig.is_float
+        self.scale = sig.scale
+        self.offset = sig.offset
+        self.multiplexer_signal = sig.multiplexer_signal
+        self.multiplexer_ids = sig.multiplexer_ids
+
+    def extract(self, little: np.ndarray, big: np.ndarray) -> np.ndarray:
+        word = little if self.little_endian else big
+        return (word >> _WORD(self.shift)) & _WORD(self.mask)
+
+    def scaled(self, raw: np.ndarray) -> np.ndarray:
+        if self.is_float:
+            if self.length == 32:
+                values = raw.astype(np.uint32).view(np.float32).astype(np.float64)
+            else:
+                values = raw.view(np.float64)
+        elif self.is_signed:
+            if self.length == 64:
+                values = raw.view(np.int64)
+            else:
+                values = raw.astype(np.int64)
+                values[values >= 1 << (self.length - 1)] -= 1 << self.length
+        else:
+            values = raw
+        return values * self.scale + self.offset
+
+    def extract_one(self, little: int, big: int) -> int:
+        word = little if self.little_endian else big
+        return (word >> self.shift) & self.mask
+
+    def scaled_one(self, raw: int):
+        if self.is_float:
+            if self.length == 32:
+                value = struct.unpack("<f", raw.to_bytes(4, "little"))[0]
+            else:
+                value = struct.unpack("<d", raw.to_bytes(8, "little"))[0]
+        elif self.is_signed and raw >= 1 << (self.length - 1):
+            value = raw - (1 << self.length)
+        else:
+            value = raw
+        return value * self.scale + self.offset
+
+
+def signal_columns(db_msg) -> List[_SignalColumn]:
+    """The compiled signals of a message, multiplexers before the signals
+    they select. Raises ValueError if the message is longer than 8 bytes."""
+    if db_msg.length > 8:
+        raise ValueError(f"{db_msg.name} is longer than 8 bytes")
+    columns = [_SignalColumn(sig) for sig in db_msg.signals]
+    parents = {col.name: col.multiplexer_signal for col in columns}
+
+    def depth(col):
+        level, parent = 0, col.multiplexer_signal
+        while parent is not None:
+            level, parent = level + 1, parents.get(parent)
+        return level
+
+    columns.sort(key=depth)
+    return columns
+
+
+class BatchDecoder:
+    """Decodes arrays of frame_batch.FRAME_DTYPE rows for one dbc message.
+
+    decode() returns a structured array with a "timestamp" column and one
+    float64 column per signal. Multiplexed signals are NaN in rows where
+    their multiplexer value does not select them.
+    """
+
+    def __init__(self, db_msg):
+        self.name = db_msg.name
+        self.frame_id = db_msg.frame_id
+        self.key = f"{db_msg.frame_id:03X}"
+        self.length = db_msg.length
+        self._signals = signal_columns(db_msg)
+        self.dtype = np.dtype(
+            [("timestamp", "<f8")] + [(col.name, "<f8") for col in self._signals]
+        )
+
+    @property
+    def signal_names(self):
+        return self.dtype.names[1:]
+
+    def decode(self, frames: np.ndarray) -> np.ndarray:
+        frames = frames[frames["dlc"] >= self.length]
+        data = np.ascontiguousarray(frames["data"])
+        little = data.view("<u8").ravel()
+        big = data.view(">u8").ravel().astype(_WORD)
+
+        out = np.empty(len(frames), dtype=self.dtype)
+        out["timestamp"] = frames["timestamp"]
+        raws: Dict[str, np.ndarray] = {}
+        for col in self._signals:
+            raw = col.extract(little, big)
+            raws[col.name] = raw
+            values = col.scaled(raw)
+            if col.multiplexer_signal is not None:
+                selected = np.isin(raws[col.multiplexer_signal], col.multiplexer_ids)
+                values = np.where(selected, values, _NAN)
+            out[col.name] = values
+        return out
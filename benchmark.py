@@ -0,0 +1,316 @@
+"""End-to-end benchmark of the rx -> redis -> decoder/logger/panda pipeline.
+
+For every combination of batch size and bus load, this runs the real process
+set of main.py (CanServer) in test mode on seeded synthetic traffic, and
+measures over a fixed window after a warmup:
+
+- average fps of every stage (from the stats every process publishes)
+- cpu of every process, in % of one core
+- latency from the frame's bus timestamp to each consumer receiving it:
+  "p50" is the median of the per second p50s, "p99" the worst per second p99
+- the last reported drop and error counters
+
+Results are written as json, so runs can be compared between releases.
+
+The collector subscribes to the signals given with --subscribe (everything
+by default) like a browser would, since the decoder only decodes signals
+some client is subscribed to.
+
+Needs redis on localhost:6379 and nothing else using it, so stop a running
+canserver first. Logging is on during the measurement (disable with
+--no_log), logs go to the usual log directory.
+
+Usage:
+    python benchmark.py --batch_sizes 10,100,1000 --bus_loads 0.25,0.5,1 -o bench.json
+    python benchmark.py --subscribe ID257DIspeed,118.DI_gear
+"""
+
+import json
+import os
+import platform
+import subprocess
+from argparse import ArgumentParser
+from datetime import datetime
+from statistics import median
+from threading import Thread
+from time import sleep, time
+
+import psutil
+import redis
+import socketio
+
+import main
+from message_queue import Emitter
+
+logger = main.logger.getChild("benchmark")
+
+
+class StatsCollector:
+    """Collects stats and process cpu of one CanServer run, in its own thread."""
+
+    def __init__(
+        self,
+        server: main.CanServer,
+        warmup: float,
+        duration: float,
+        log,
+        subscription: dict,
+    ):
+        self.server = server
+        self.subscription = subscription
+        self.warmup = warmup
+        self.duration = duration
+        self.log = log
+        self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, "canserver.benchmark")
+        self.measuring = False
+        self.fps = {}
+        self.latency = {}
+        self.counters = {}
+        self.cpu = {}
+        self.error = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self.sio.on("stats", self._on_stats)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+        if self.sio.connected:
+            self.sio.disconnect()
+
+    def _run(self):
+        try:
+            while not self.server.rx_procs:
+                if self.server.killer.kill_now:
+                    return
+                sleep(0.1)
+            test_start = self.server.test_start
+            self.sio.connect(
+                f"http://{self.server.server_address}",
+                headers={"X-Username": "canserver.benchmark"},
+                wait_timeout=60,
+            )
+            result = self.sio.call("subscribe", self.subscription, timeout=10)
+            if result.get("error"):
+                raise Exception(f"Subscription failed: {result['error']}")
+            # every client is connected by the time the replay starts
+            sleep(max(test_start - time(), 0))
+            if self.log:
+                self.emitter.emit("logging_control", "start")
+            sleep(max(test_start + self.warmup - time(), 0))
+            procs = self._processes()
+            cpu_start = {name: _cpu_seconds(proc) for name, proc in procs.items()}
+            self.measuring = True
+            sleep(self.duration)
+            self.measuring = False
+            for name, proc in procs.items():
+                used = _cpu_seconds(proc) - cpu_start[name]
+                self.cpu[name] = round(100 * used / self.duration, 1)
+            if self.log:
+                self.emitter.emit("logging_control", "stop")
+        except Exception as e:
+            self.error = e
+
+    def _processes(self):
+        procs = {"server": psutil.Process(self.server.server_proc.pid)}
+        for proc in self.server.client_procs:
+            procs[_process_name(proc.args)] = psutil.Process(proc.pid)
+        return procs
+
+    def _on_stats(self, data):
+        if not self.measuring:
+            return
+        for stage, fps in data.get("fps", {}).items():
+            self.fps.setdefault(stage, []).append(fps)
+        for key, stat in data.get("system", {}).items():
+            if stat is None:
+                continue
+            for suffix in (" latency p50", " latency p99"):
+                if key.endswith(suffix):
+                    percentiles = self.latency.setdefault(key[: -len(suffix)], {})
+                    percentiles.setdefault(suffix[-3:], []).append(stat["value"])
+            if key.endswith(" dropped") or key.endswith(" errors"):
+                self.counters[key] = stat["value"]
+
+    def result(self):
+        latency = {}
+        for consumer, percentiles in sorted(self.latency.items()):
+            latency[consumer] = {
+                "p50_ms": median(percentiles.get("p50", [0])),
+                "p99_ms": max(percentiles.get("p99", [0])),
+            }
+        return {
+            "fps": {
+                stage: round(sum(values) / len(values))
+                for stage, values in sorted(self.fps.items())
+            },
+            "cpu": dict(sorted(self.cpu.items())),
+            "latency": latency,
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+def _process_name(cmd):
+    name = os.path.splitext(os.path.basename(cmd[1]))[0]
+    if name in ("can_rx_client", "can_logger_client"):
+        name += "." + (cmd[cmd.index("-c") + 1] if "-c" in cmd else "can0")
+    return name
+
+
+def _cpu_seconds(proc: psutil.Process) -> float:
+    try:
+        times = proc.cpu_times()
+    except psutil.NoSuchProcess:
+        return 0.0
+    return times.user + times.system
+
+
+def run_case(args, batch_size, bus_load):
+    server = main.CanServer(
+        args.address,
+        args.panda_bind,
+        batch_size,
+        args.batch_age,
+        args.publish_rate,
+        True,
+        1.0,
+        "synthetic",
+        args.warmup + args.duration + 1,
+        False,
+    )
+    # consumers only measure frame latency when asked to
+    for cmd in (
+        server.logger_client_cmd,
+        server.decoder_client_cmd,
+        server.panda_server_cmd,
+    ):
+        cmd.append("--frame_latency")
+    server.rx_client_cmd += [
+        "--test_bus_load",
+        str(bus_load),
+        "--test_bitrate",
+        str(args.bitrate),
+        "--test_seed",
+        str(args.seed),
+    ]
+    collector = StatsCollector(
+        server, args.warmup, args.duration, not args.no_log, _subscription(args)
+    )
+    collector.start()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.shutdown(send_sigint=False, reason="KeyboardInterrupt")
+        raise
+    except Exception as e:
+        logger.exception(e)
+        server.shutdown(reason=e)
+    finally:
+        collector.join()
+    if collector.error:
+        raise collector.error
+    return collector.result()
+
+
+def _subscription(args):
+    return {"signals": args.subscribe.split(","), "format": "delta"}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmark the canserver pipeline")
+    parser.add_argument(
+        "--batch_sizes",
+        default="10,100,1000",
+        help="Comma separated maximum batch sizes to run",
+    )
+    parser.add_argument(
+        "--bus_loads",
+        default="0.25,0.5,1",
+        help="Comma separated synthetic bus loads (0 to 1) to run",
+    )
+    parser.add_argument(
+        "--bitrate",
+        default=500000,
+        type=int,
+        help="Bitrate the bus loads are relative to, raise it for higher frame rates",
+    )
+    parser.add_argument(
+        "--duration", default=30, type=float, help="Seconds measured per run"
+    )
+    parser.add_argument(
+        "--warmup", default=5, type=float, help="Seconds before measuring per run"
+    )
+    parser.add_argument("--seed", default=1, type=int, help="Synthetic traffic seed")
+    parser.add_argument("--batch_age", default=0.02, type=float)
+    parser.add_argument("--publish_rate", default=100, type=float)
+    parser.add_argument(
+        "--no_log", action="store_true", help="Don't write logs during the runs"
+    )
+    parser.add_argument(
+        "--subscribe",
+        default="*",
+        help="Comma separated signals to subscribe to, see subscriptions.py",
+    )
+    parser.add_argument("--address", "-a", default="127.0.0.1:5055")
+    parser.add_argument("--panda_bind", "-p", default="127.0.0.1:1339")
+    parser.add_argument(
+        "--output", "-o", default="benchmark.json", help="Results file to write"
+    )
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    redis.StrictRedis("localhost", 6379).ping()
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": psutil.cpu_count(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "bitrate": args.bitrate,
+            "seed": args.seed,
+            "batch_age": args.batch_age,
+            "publish_rate": args.publish_rate,
+            "log": not args.no_log,
+            "subscription": _subscription(args),
+            "pican_duo": main.cfg.pican_duo,
+            "log_format": main.cfg.log_format,
+        },
+        "runs": [],
+    }
+    for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+        for bus_load in [float(x) for x in args.bus_loads.split(",")]:
+            logger.info(f"benchmark: batch size {batch_size}, bus load {bus_load}")
+            run = {"batch_size": batch_size, "bus_load": bus_load}
+            run.update(run_case(args, batch_size, bus_load))
+            results["runs"].append(run)
+            # write after every run, so a long sweep keeps what it measured
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+            logger.info(json.dumps(run))
+    logger.info(f"wrote {len(results['runs'])} runs to {args.output}")
+
+
+if __name__ == "__main__":
+    try:
+        run()
+    finally:
+        main.server_stderr.close()
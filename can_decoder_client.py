@@ -1,34 +1,135 @@
 import logging
-import pickle
 from argparse import ArgumentParser
 from time import time, sleep
+from typing import Dict, FrozenSet, List, Optional
 
 import cantools
+import numpy as np
 import redis
 import socketio
-from can import Message
 
 import config as cfg
+import frame_batch
+import plot_stream
+import snapshot
+import subscriptions
+import timeseries
+import vehicle_stream
+from batch_decoder import BatchDecoder, signal_columns
+from frame_table import LatestFrameTable
+from latency import LatencyStats, frame_ages
 from logging_setup import setup_logging
+from message_queue import Emitter
 
 setup_logging()
 
 
+class DecodePlan:
+    """Everything needed to decode one filtered frame id, resolved at startup.
+
+    decode() extracts only the signals passed to select() (and the
+    multiplexers they depend on) with the compiled columns of
+    batch_decoder.py. Messages longer than 8 bytes fall back to cantools.
+    """
+
+    __slots__ = (
+        "name",
+        "key",
+        "length",
+        "signals",
+        "wanted",
+        "_db_decode",
+        "_columns",
+        "_selected",
+    )
+
+    def __init__(self, db_msg):
+        self.name = db_msg.name
+        self.key = f"{db_msg.frame_id:03X}"
+        self.length = db_msg.length
+        # signal name -> (unit, {raw value: state name} or None)
+        self.signals = {}
+        for sig in db_msg.signals:
+            choices = None
+            if sig.choices:
+                choices = {k: str(v) for k, v in sig.choices.items()}
+            self.signals[sig.name] = (sig.unit, choices)
+        self._db_decode = db_msg.decode
+        try:
+            self._columns = signal_columns(db_msg)
+        except ValueError:
+            self._columns = None
+        self.select(None)
+
+    def select(self, wanted: Optional[FrozenSet]) -> None:
+        """Decode only these signals from now on, None for all of them."""
+        self.wanted = wanted
+        if self._columns is None:
+            self._selected = None
+            return
+        names = set(self.signals if wanted is None else wanted)
+        parents = {col.name: col.multiplexer_signal for col in self._columns}
+        for name in list(names):
+            parent = parents.get(name)
+            while parent is not None and parent not in names:
+                names.add(parent)
+                parent = parents.get(parent)
+        self._selected = [col for col in self._columns if col.name in names]
+
+    def decode(self, data: bytes) -> Dict[str, float]:
+        """Values of the selected signals in a payload, choices not applied."""
+        wanted = self.wanted
+        if self._selected is None:
+            values = self._db_decode(data, decode_choices=False)
+            if wanted is None:
+                return values
+            return {k: v for k, v in values.items() if k in wanted}
+        if len(data) < self.length:
+            raise ValueError(f"{len(data)} bytes, {self.name} has {self.length}")
+        payload = bytes(data[:8]).ljust(8, b"\0")
+        little = int.from_bytes(payload, "little")
+        big = int.from_bytes(payload, "big")
+        raws = {}
+        values = {}
+        for col in self._selected:
+            if col.multiplexer_signal is not None:
+                if raws.get(col.multiplexer_signal) not in col.multiplexer_ids:
+                    continue
+            raw = col.extract_one(little, big)
+            raws[col.name] = raw
+            if wanted is None or col.name in wanted:
+                values[col.name] = col.scaled_one(raw)
+        return values
+
+
 class CanDecoder:
     def __init__(self):
         self._parse_args()
         self.logger = logging.getLogger("can_decoder")
         self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, "can_decoder")
         self.red = redis.StrictRedis("localhost", 6379)
         self.red_sub = self.red.pubsub()
 
-        self._signal_cache = {}
+        self._decode_plan: Dict[int, DecodePlan] = {}
         self._setup_decoding()
+        # subscription rooms, None to decode everything and emit to all clients
+        self._rooms: Optional[List[subscriptions.Room]] = None
+        self._decode_signals = {frame_id: None for frame_id in self._decode_plan}
+        self._plot_rooms: List[plot_stream.PlotRoom] = []
+        self._plot_decoders: Dict[int, BatchDecoder] = {}
+        self._plot_ids = np.array([], dtype=np.uint32)
+        self._plot_frames = []
+        self._plot_start = time()
+        self.plot_count = 0
         self._failed_messages = []
-        self._last_decoded_ts = {"id": "ts"}
         self.count_start = time()
         self.frame_count = 0
-        self._msg_batch = []
+        self.sample_count = 0
+        self.timeseries_count = 0
+        self._sample_frames = []
+        self._latest_frames = LatestFrameTable()
+        self._latency = LatencyStats()
         self._batch_start = time()
         self._batch_interval = cfg.decode_interval
         self._callbacks()
@@ -41,9 +142,15 @@ class CanDecoder:
             default="http://localhost:8000",
             help="Socket.IO server to use",
         )
+        parser.add_argument(
+            "--frame_latency",
+            action="store_true",
+            help="Measure frame latency without cfg.trace_latency (benchmark.py)",
+        )
 
         args = parser.parse_args()
         self.server_address = args.server
+        self._frame_latency = cfg.trace_latency or args.frame_latency
 
     def _setup_decoding(self):
         dbc_file = cfg.dbc_file
@@ -53,21 +160,56 @@ class CanDecoder:
 
         self.db = cantools.db.load_file(dbc_file)
 
-        self._decode_filter = []
         for name in include_list:
             try:
                 db_msg = self.db.get_message_by_name(name)
-                self._decode_filter.append(db_msg.frame_id)
-                self._signal_cache[db_msg.frame_id] = {}
-                for sig in db_msg.signals:
-                    self._signal_cache[db_msg.frame_id][sig.name] = sig
             except KeyError:
                 raise Exception(f"Filter message '{name}' not found in dbc.")
+            self._decode_plan[db_msg.frame_id] = DecodePlan(db_msg)
+        self._frame_ids = {plan.key: fid for fid, plan in self._decode_plan.items()}
+        self._names = {plan.key: plan.name for plan in self._decode_plan.values()}
+
+        self._sample_decoders: Dict[int, BatchDecoder] = {}
+        for name in cfg.sample_filter:
+            try:
+                db_msg = self.db.get_message_by_name(name)
+            except KeyError:
+                raise Exception(f"Sample message '{name}' not found in dbc.")
+            self._sample_decoders[db_msg.frame_id] = BatchDecoder(db_msg)
+
+        self._timeseries = None
+        self._timeseries_ids = set()
+        batch_decoders = dict(self._sample_decoders)
+        for name in cfg.timeseries_filter:
+            try:
+                db_msg = self.db.get_message_by_name(name)
+            except KeyError:
+                raise Exception(f"Time series message '{name}' not found in dbc.")
+            if db_msg.frame_id not in batch_decoders:
+                batch_decoders[db_msg.frame_id] = BatchDecoder(db_msg)
+            self._timeseries_ids.add(db_msg.frame_id)
+        if self._timeseries_ids:
+            self._timeseries = timeseries.TimeSeriesWriter(cfg.timeseries_dir)
+        # sampled and stored messages, decoded together every decode_interval
+        self._batch_decoders: Dict[int, BatchDecoder] = batch_decoders
+        self._sample_ids = np.array(list(batch_decoders), dtype=np.uint32)
 
-        # remove duplicates:
-        self._decode_filter = list(set(self._decode_filter))
+        self._vehicle_stream = None
+        if cfg.vehicle_stream == "delta":
+            if not cfg.sio_message_queue:
+                raise Exception("vehicle_stream 'delta' needs sio_message_queue")
+            self._vehicle_stream = vehicle_stream.VehicleStream(
+                self._decode_plan.values(),
+                snapshot_interval=cfg.vehicle_snapshot_interval,
+                use_msgpack=cfg.vehicle_stream_msgpack,
+            )
+            vehicle_stream.save_schema(self.red, self._vehicle_stream.schema)
+        elif cfg.vehicle_stream != "legacy":
+            raise Exception("vehicle_stream must be 'legacy' or 'delta'")
 
-        self.logger.debug(f"Decoding {len(self._decode_filter)} filtered messages.")
+        self.logger.debug(f"Decoding {len(self._decode_plan)} filtered messages.")
+        self.logger.debug(f"Sampling {len(self._sample_decoders)} messages.")
+        self.logger.debug(f"Storing {len(self._timeseries_ids)} messages.")
 
     def run(self):
         try:
@@ -77,6 +219,11 @@ class CanDecoder:
                 wait_timeout=60,
             )
             self.red_sub.psubscribe(**{"can*_frame_batch": self._pubsub_handler})
+            if cfg.sio_message_queue:
+                self.red_sub.subscribe(
+                    **{subscriptions.CHANGED_CHANNEL: self._subscriptions_handler}
+                )
+                self._load_subscriptions()
             self._pubsub_thread = self.red_sub.run_in_thread(
                 sleep_time=0.1, daemon=True
             )
@@ -92,68 +239,218 @@ class CanDecoder:
 
     def shutdown(self):
         self._pubsub_thread.stop()
+        if self._timeseries is not None:
+            self._pubsub_thread.join(timeout=1)
+            self._timeseries.close()
 
     def _pubsub_handler(self, msg):
         if msg and isinstance(msg, dict) and msg["type"] == "pmessage":
-            pickled_batch = msg.get("data")
-            batch = pickle.loads(pickled_batch)
-            self._on_frame_batch(batch)
+            packed_batch = msg.get("data")
+            now = time()
+            if self._frame_latency:
+                self._latency.add("decoder latency", frame_ages(packed_batch, now))
+            if cfg.trace_latency:
+                publish_time = frame_batch.publish_time(packed_batch)
+                if publish_time is not None:
+                    self._latency.add("decoder redis latency", now - publish_time)
+            if self._batch_decoders or self._plot_rooms:
+                self._collect_samples(packed_batch)
+            _, frames = frame_batch.unpack(packed_batch)
+            self._on_frame_batch(frames)
+
+    def _subscriptions_handler(self, msg):
+        if msg and isinstance(msg, dict) and msg["type"] == "message":
+            self._load_subscriptions()
+
+    def _load_subscriptions(self):
+        rooms = [
+            subscriptions.Room.resolve(room, subscription, self._decode_plan)
+            for room, subscription in subscriptions.load(self.red).items()
+        ]
+        if self._vehicle_stream is not None:
+            for room in rooms:
+                room.indexes = self._vehicle_stream.indexes(
+                    {
+                        self._decode_plan[frame_id].key: signals
+                        for frame_id, signals in room.wanted.items()
+                    }
+                )
+            # values of newly subscribed signals are stale, start over
+            self._vehicle_stream.reset()
+        self._decode_signals = subscriptions.merge(rooms)
+        for frame_id, plan in self._decode_plan.items():
+            plan.select(self._decode_signals.get(frame_id))
+        self._rooms = rooms
+        self.logger.debug(
+            f"{len(rooms)} subscriptions, decoding {len(self._decode_signals)} messages."
+        )
+        self._load_plot_rooms()
+
+    def _load_plot_rooms(self):
+        rooms = [
+            plot_stream.PlotRoom.resolve(room, subscription, self.db)
+            for room, subscription in subscriptions.load(
+                self.red, plot_stream.KIND
+            ).items()
+        ]
+        decoders = {}
+        for room in rooms:
+            for frame_id in room.columns:
+                if frame_id in decoders:
+                    continue
+                decoder = self._plot_decoders.get(frame_id)
+                if decoder is None:
+                    decoder = self._batch_decoders.get(frame_id)
+                if decoder is None:
+                    db_msg = self.db.get_message_by_frame_id(frame_id)
+                    try:
+                        decoder = BatchDecoder(db_msg)
+                    except ValueError as e:
+                        self.logger.warning(f"Can't plot {db_msg.name}: {e}")
+                        continue
+                decoders[frame_id] = decoder
+        self._plot_decoders = decoders
+        self._plot_ids = np.array(list(decoders), dtype=np.uint32)
+        self._plot_rooms = rooms
+        if not rooms:
+            self._plot_frames = []
+
+    def _collect_samples(self, packed_batch):
+        frames = frame_batch.to_array(packed_batch)
+        wanted = np.isin(frames["arbitration_id"], self._sample_ids)
+        if wanted.any():
+            self._sample_frames.append(frames[wanted])
+        if self._plot_rooms:
+            wanted = np.isin(frames["arbitration_id"], self._plot_ids)
+            if wanted.any():
+                self._plot_frames.append(frames[wanted])
 
     def _on_frame_batch(self, batch):
-        self._msg_batch.extend(batch)
+        wanted = self._decode_signals
+        self._latest_frames.update(frame for frame in batch if frame[1] in wanted)
         now = time()
+        if self._plot_rooms and now >= self._plot_start + cfg.plot_interval:
+            self._emit_plots()
+            self._plot_start = now
         if now >= self._batch_start + self._batch_interval:
-            batch = self._msg_batch
-            batch.reverse()
+            self._decode_samples()
             decoded_batch = {}
-            for msg in batch:
-                decoded = self._decode(msg)
+            timestamps = []
+            for frame_id, frame in self._latest_frames.drain():
+                if frame_id not in wanted:
+                    continue
+                decoded = self._decode(frame)
                 if decoded:
                     decoded_batch.update(decoded)
-            if self.sio.connected and decoded_batch:
-                self.sio.emit("broadcast_vehicle_stats", decoded_batch)
+                    timestamps.append(frame[0])
+            if decoded_batch:
+                self._emit_vehicle_stats(decoded_batch, now)
+                snapshot.save_vehicle(self.red, decoded_batch, self._names, now)
+                if cfg.trace_latency:
+                    self._latency.add(
+                        "decoder emit latency", time() - np.array(timestamps)
+                    )
 
             self.frame_count += len(decoded_batch)
-            self._msg_batch = []
             self._batch_start = now
 
-    def _decode(self, message: Message):
-        if message.arbitration_id not in self._decode_filter:
-            return None
-        try:
-            if self._last_decoded_ts[message.arbitration_id] >= message.timestamp:
-                return None
-        except:
-            pass
-        try:
-            db_msg = self.db.get_message_by_frame_id(message.arbitration_id)
-        except KeyError:
+    def _emit_vehicle_stats(self, decoded_batch, now):
+        if self._rooms is None:
+            self.emitter.emit("vehicle_stats", decoded_batch)
+            return
+        update = None
+        if self._vehicle_stream is not None:
+            update = self._vehicle_stream.changes(decoded_batch, now)
+        for room in self._rooms:
+            if room.indexes is not None and room.format == "delta":
+                if update is None:
+                    continue
+                payload = self._vehicle_stream.encode(update, room.indexes)
+                if payload is not None:
+                    self.emitter.emit("vehicle_delta", payload, to=room.name)
+            else:
+                payload = room.select(decoded_batch, self._frame_ids)
+                if payload:
+                    self.emitter.emit("vehicle_stats", payload, to=room.name)
+
+    def _emit_plots(self):
+        if not self._plot_frames:
+            return
+        frames = np.concatenate(self._plot_frames)
+        self._plot_frames = []
+        frames = frames[np.argsort(frames["timestamp"], kind="stable")]
+        series = {room.name: [] for room in self._plot_rooms}
+        for frame_id, decoder in self._plot_decoders.items():
+            rows = frames[frames["arbitration_id"] == frame_id]
+            if not len(rows):
+                continue
+            try:
+                samples = decoder.decode(rows)
+            except Exception as e:
+                if decoder.name not in self._failed_messages:
+                    self._failed_messages.append(decoder.name)
+                    self.logger.warning(f"Failed to plot {decoder.name}: {e}")
+                continue
+            self.plot_count += len(samples)
+            for room in self._plot_rooms:
+                room_series = room.series(frame_id, samples)
+                if room_series is not None:
+                    series[room.name].append(room_series)
+        for room, room_series in series.items():
+            if room_series:
+                self.emitter.emit("plot", {"series": room_series}, to=room)
+
+    def _decode_samples(self):
+        if not self._sample_frames:
+            return
+        frames = np.concatenate(self._sample_frames)
+        self._sample_frames = []
+        frames = frames[np.argsort(frames["timestamp"], kind="stable")]
+        for frame_id, decoder in self._batch_decoders.items():
+            rows = frames[frames["arbitration_id"] == frame_id]
+            if not len(rows):
+                continue
+            try:
+                samples = decoder.decode(rows)
+            except Exception as e:
+                if decoder.name not in self._failed_messages:
+                    self._failed_messages.append(decoder.name)
+                    self.logger.warning(f"Failed to sample {decoder.name}: {e}")
+                continue
+            if frame_id in self._sample_decoders:
+                self.red.publish(f"{decoder.key}_samples", samples.tobytes())
+                self.sample_count += len(samples)
+            if frame_id in self._timeseries_ids:
+                self.timeseries_count += self._timeseries.append(decoder.name, samples)
+
+    def _decode(self, frame: frame_batch.Frame):
+        timestamp, arbitration_id, _, dlc, data = frame
+        plan = self._decode_plan.get(arbitration_id)
+        if plan is None:
             return None
 
         try:
-            decoded_data = db_msg.decode(message.data)
-            for k, v in decoded_data.items():
-                unit = self._signal_cache[message.arbitration_id][k].unit
-                if isinstance(v, cantools.db.can.signal.NamedSignalValue):
-                    decoded_data[k] = {"state": v.name, "value": v.value}
-                else:
-                    decoded_data[k] = {"value": v, "unit": unit}
+            raw = plan.decode(data[:dlc])
         except Exception as e:
-            if db_msg.name not in self._failed_messages:
-                self._failed_messages.append(db_msg.name)
-                self.logger.warning(f"Failed to decode {db_msg.name}: {e}")
+            if plan.name not in self._failed_messages:
+                self._failed_messages.append(plan.name)
+                self.logger.warning(f"Failed to decode {plan.name}: {e}")
             return None
 
-        self._last_decoded_ts[message.arbitration_id] = message.timestamp
-
-        frame_id = hex(message.arbitration_id).upper()[2:]
-        while len(frame_id) < 3:
-            frame_id = "0" + frame_id
+        decoded_data = {}
+        signals = plan.signals
+        for k, v in raw.items():
+            unit, choices = signals[k]
+            state = choices.get(v) if choices else None
+            if state is not None:
+                decoded_data[k] = {"state": state, "value": v}
+            else:
+                decoded_data[k] = {"value": v, "unit": unit}
 
         return {
-            frame_id: {
+            plan.key: {
                 "data": decoded_data,
-                "timestamp": message.timestamp,
+                "timestamp": timestamp,
             }
         }
 
@@ -161,10 +458,30 @@ class CanDecoder:
         now = time()
         delta = now - self.count_start
         fps = int(self.frame_count / delta)
-        if self.sio.connected:
-            self.sio.emit("broadcast_stats", {"fps": {"decoder": fps}})
+        sps = int(self.sample_count / delta)
+        pps = int(self.plot_count / delta)
+        tps = int(self.timeseries_count / delta)
+        system = self._latency.stats()
+        if self._timeseries is not None:
+            system["decoder timeseries dropped"] = {"value": self._timeseries.dropped}
+        self.emitter.emit(
+            "stats",
+            {
+                "fps": {
+                    "decoder": fps,
+                    "decoder samples": sps,
+                    "decoder plot": pps,
+                    "decoder timeseries": tps,
+                },
+                "system": system,
+            },
+        )
+        self._latency.reset()
         self.count_start = now
         self.frame_count = 0
+        self.sample_count = 0
+        self.plot_count = 0
+        self.timeseries_count = 0
 
     def _callbacks(self):
         @self.sio.event
@@ -177,8 +494,16 @@ class CanDecoder:
             self.count_start = now
             self.frame_count = 0
             self._batch_start = now
-            self._last_decoded_ts = {}
-            self._msg_batch = []
+            self._latest_frames.clear()
+            if self._vehicle_stream is not None:
+                self._vehicle_stream.reset()
+            self._sample_frames = []
+            self.sample_count = 0
+            self._plot_frames = []
+            self.plot_count = 0
+            if self._timeseries is not None:
+                self._timeseries.time_reset()
+            self._latency.reset()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,22 @@
+import itertools
 import logging
 import os
-import pickle
 from argparse import ArgumentParser
 from datetime import datetime
+from threading import Lock
 from time import sleep, time
 
 import redis
 import socketio
-from can import ASCWriter
+from can.util import channel2int
 
 import config as cfg
+import frame_batch
+import frame_log
+import log_index
+from latency import LatencyStats, frame_ages
 from logging_setup import setup_logging
+from message_queue import Emitter
 
 setup_logging()
 
@@ -20,6 +26,7 @@ class CanLogger:
         self.parse_args()
         self.logger = logging.getLogger(f"can_logger.{self.channel}")
         self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, f"can_logger.{self.channel}")
         self.red = redis.StrictRedis("localhost", 6379)
         self.red_sub = self.red.pubsub()
 
@@ -37,6 +44,12 @@ class CanLogger:
         self.count_start = time()
         self.frame_count = 0
         self._last_gear_state_time = 0.0
+        self._flagged_log_stop_time = 0.0
+        self._log_lock = Lock()
+        self._latency = LatencyStats()
+        self._pre_trigger = frame_log.PreTriggerBuffer(
+            cfg.pre_trigger_seconds, cfg.pre_trigger_max_bytes
+        )
         self._callbacks()
 
     def parse_args(self):
@@ -56,11 +69,21 @@ class CanLogger:
             default="http://localhost:8000",
             help="Socket.IO server to use",
         )
+        parser.add_argument(
+            "--frame_latency",
+            action="store_true",
+            help="Measure frame latency without cfg.trace_latency (benchmark.py)",
+        )
 
         args = parser.parse_args()
         self.channel = args.channel
+        self.channel_index = channel2int(self.channel) or 0
+        if cfg.log_format not in frame_log.WRITERS:
+            raise Exception(f"log_format must be one of {list(frame_log.WRITERS)}")
+        self.log_format = cfg.log_format
         self.server_address = args.server
         self.log_dir = args.log_dir
+        self._frame_latency = cfg.trace_latency or args.frame_latency
 
     def run(self):
         try:
@@ -82,10 +105,10 @@ class CanLogger:
                     and self.logging
                     and time() > self._last_gear_state_time + 2
                 ):
-                    self.sio.emit(
-                        "broadcast_message",
-                        "log stopped because vehicle is off",
-                    )
+                    self.emitter.send("log stopped because vehicle is off")
+                    self._stop_logging()
+                if self._flagged_log_stop_time and time() > self._flagged_log_stop_time:
+                    self.emitter.send("flagged log complete")
                     self._stop_logging()
                 self._stats_publisher()
         except KeyboardInterrupt:
@@ -100,63 +123,121 @@ class CanLogger:
         self._pubsub_thread.stop()
 
     def _pubsub_handler(self, msg):
-        if not self.logging:
-            return
         if msg and isinstance(msg, dict) and msg["type"] == "message":
-            pickled_batch = msg.get("data")
-            batch = pickle.loads(pickled_batch)
-            self._on_frame_batch(batch)
-
-    def _on_frame_batch(self, batch):
-        for msg in batch:
-            self.writer.on_message_received(msg)
+            self._on_frame_batch(msg.get("data"))
 
-        self.frame_count += len(batch)
+    def _on_frame_batch(self, packed_batch):
+        now = time()
+        if self._frame_latency:
+            self._latency.add(
+                f"{self.channel} log latency", frame_ages(packed_batch, now)
+            )
+        if cfg.trace_latency:
+            publish_time = frame_batch.publish_time(packed_batch)
+            if publish_time is not None:
+                self._latency.add(
+                    f"{self.channel} log redis latency", now - publish_time
+                )
+        with self._log_lock:
+            if self.logging:
+                self.frame_count += self.writer.write_batch(packed_batch)
+            else:
+                self._pre_trigger.append(packed_batch, now)
 
     def _start_logging(self):
-        if self.logging:
-            return
-        self.flag_this_log = False
-        start_time = datetime.now()
-        self.file_name = (
-            start_time.strftime("%Y-%m-%d_%H.%M.%S_") + self.channel + ".asc"
-        )
-        self.file_path = f"{self.log_dir}/{self.file_name}"
-        self.writer = ASCWriter(self.file_path)
+        # called from the main loop and from socket.io callbacks
+        with self._log_lock:
+            if self.logging:
+                return
+            self.flag_this_log = False
+            self._flagged_log_stop_time = 0.0
+            stamp = datetime.now().strftime("%Y-%m-%d_%H.%M.%S.%f")[:-3]
+            extension = frame_log.EXTENSIONS[self.log_format]
+            # the previous log may still be closing, never reuse its name
+            suffix = ""
+            for n in itertools.count(1):
+                self.file_name = f"{stamp}_{self.channel}{suffix}{extension}"
+                self.file_path = f"{self.log_dir}/{self.file_name}"
+                flagged_path = f"{self.log_dir}/flagged/{self.file_name}"
+                if not os.path.exists(self.file_path) and not os.path.exists(
+                    flagged_path
+                ):
+                    break
+                suffix = f"_{n}"
+            pre_roll = self._pre_trigger.drain()
+            self.writer = frame_log.AsyncLogWriter(
+                frame_log.WRITERS[self.log_format](self.file_path, self.channel_index),
+                queue_size=1000 + len(pre_roll),
+                fsync_interval=cfg.log_fsync_interval,
+            )
+            for packed_batch in pre_roll:
+                self.writer.write_batch(packed_batch)
 
-        self.count_start = time()
-        self.frame_count = 0
-        self.logging = True
+            self.count_start = time()
+            self.frame_count = 0
+            self.logging = True
 
     def _stop_logging(self):
-        if not self.logging:
-            return
-        self.logging = False
-        sleep(0.1)  # prevent race condition with writing thread.
-        self.writer.stop()
-        if self.flag_this_log:
-            os.replace(self.file_path, f"{self.log_dir}/flagged/{self.file_name}")
+        # only the thread that ends the log closes and moves its files
+        with self._log_lock:
+            if not self.logging:
+                return
+            self.logging = False
+            self._flagged_log_stop_time = 0.0
+            writer = self.writer
+            file_name = self.file_name
+            file_path = self.file_path
+            flagged = self.flag_this_log
+        # returns once every accepted batch is on disk and the file is closed
+        writer.stop()
+        if writer.dropped_frames:
+            self.logger.warning(
+                f"{writer.dropped_frames} frames dropped from {file_name}"
+            )
+        if flagged:
+            flagged_path = f"{self.log_dir}/flagged/{file_name}"
+            os.replace(file_path, flagged_path)
+            index_path = log_index.index_path(file_path)
+            if os.path.exists(index_path):
+                os.replace(index_path, log_index.index_path(flagged_path))
 
     def _stats_publisher(self):
         now = time()
         delta = now - self.count_start
         fps = int(self.frame_count / delta)
-        if self.sio.connected:
-            self.sio.emit(
-                "broadcast_stats",
-                {
-                    "fps": {f"{self.channel} log": fps},
-                    "system": {
-                        f"{self.channel} log file": {"value": self.file_name},
-                        f"{self.channel} logging": {"value": self.logging},
-                        f"{self.channel} auto-log": {"value": self.auto_start_stop_log},
-                    },
+        log_queue = 0
+        log_dropped = 0
+        if self.writer is not None:
+            log_queue = self.writer.queue_depth
+            log_dropped = self.writer.dropped_frames
+        self.emitter.emit(
+            "stats",
+            {
+                "fps": {f"{self.channel} log": fps},
+                "system": {
+                    f"{self.channel} log file": {"value": self.file_name},
+                    f"{self.channel} logging": {"value": self.logging},
+                    f"{self.channel} auto-log": {"value": self.auto_start_stop_log},
+                    f"{self.channel} log queue": {"value": log_queue},
+                    f"{self.channel} log dropped": {"value": log_dropped},
+                    **self._latency.stats(),
                 },
-            )
+            },
+        )
+        self._latency.reset()
         self.count_start = now
         self.frame_count = 0
 
     def _callbacks(self):
+        @self.sio.event
+        def connect():
+            signals = [
+                f"{cfg.vehicle_gear_frame_id}.{cfg.vehicle_gear_signal_name}",
+                f"{cfg.auto_logging_frame_id}.{cfg.auto_logging_signal_name}",
+                f"{cfg.flag_log_frame_id}.{cfg.flag_log_signal_name}",
+            ]
+            self.sio.emit("subscribe", {"signals": signals})
+
         @self.sio.event
         def connect_error(e):
             self.logger.error(e)
@@ -166,6 +247,7 @@ class CanLogger:
             if data == "start":
                 if not self.disk_full:
                     self._start_logging()
+                    self._flagged_log_stop_time = 0.0
                     msg = "log started by request"
                 else:
                     msg = "log not started, disk full"
@@ -182,7 +264,7 @@ class CanLogger:
                 self.auto_start_stop_log = False
                 msg = "auto logging disabled by request"
 
-            self.sio.emit("broadcast_message", msg)
+            self.emitter.send(msg)
 
         @self.sio.event
         def time_reset():
@@ -190,6 +272,9 @@ class CanLogger:
             self.count_start = now
             self.frame_count = 0
             self._last_gear_state_time = now
+            self._latency.reset()
+            with self._log_lock:
+                self._pre_trigger.clear()
 
         @self.sio.event
         def stats(data):
@@ -204,8 +289,8 @@ class CanLogger:
                 if usage <= 90 and self.disk_full:
                     self.disk_full = False
                     msg = "logging reenabled, disk no longer full"
-            if msg and self.sio.connected:
-                self.sio.emit("broadcast_message", msg)
+            if msg:
+                self.emitter.send(msg)
 
         @self.sio.event
         def vehicle_stats(data):
@@ -218,6 +303,9 @@ class CanLogger:
                     in cfg.vehicle_gear_logging_states
                 ):
                     self._last_gear_state_time = time()
+                    if self.auto_start_stop_log:
+                        # driving keeps a flag-started log open
+                        self._flagged_log_stop_time = 0.0
                     if (
                         not self.logging
                         and self.auto_start_stop_log
@@ -259,7 +347,14 @@ class CanLogger:
                         and time() - self.first_flag_log_time
                         >= cfg.flag_log_signal_duration
                     ):
-                        msg = "log flagged"
+                        if not self.logging and not self.disk_full:
+                            self._start_logging()
+                            self._flagged_log_stop_time = (
+                                time() + cfg.flag_log_post_trigger_seconds
+                            )
+                            msg = "log started and flagged"
+                        else:
+                            msg = "log flagged"
                         self.flag_this_log = True
                     elif not self.last_flag_log_signal:
                         self.first_flag_log_time = time()
@@ -267,8 +362,8 @@ class CanLogger:
                 elif self.last_flag_log_signal:
                     self.last_flag_log_signal = False
 
-            if msg and self.sio.connected:
-                self.sio.emit("broadcast_message", msg)
+            if msg:
+                self.emitter.send(msg)
 
 
 if __name__ == "__main__":
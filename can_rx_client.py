@@ -1,15 +1,23 @@
 import logging
-import pickle
 from argparse import ArgumentParser
+from queue import Empty, Full, Queue
 from threading import Thread
 from time import sleep, time
 
 import can
+import cantools
 import redis
 import socketio
 from can import ASCReader
+from can.util import channel2int
 
+import config as cfg
+import frame_batch
+from latency import LatencyStats, frame_ages
 from logging_setup import setup_logging
+from message_queue import Emitter
+from replay import ReplayClock
+from synthetic_traffic import SyntheticTraffic
 
 setup_logging()
 
@@ -19,12 +27,28 @@ class CanReader:
         self._parse_args()
         self.logger = logging.getLogger(f"can_rx_client.{self.channel}")
         self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, f"can_rx_client.{self.channel}")
         self.red = redis.StrictRedis("localhost", 6379)
 
         self.count_start = time()
         self.frame_count = 0
         self._msg_batch = []
+        self._batch_deadline = 0.0
+        self._target_batch_size = 1
+        self._rate_estimate = None
+        self._flush_counts = {"size": 0, "age": 0}
+        self._batch_fill_sum = 0.0
+        self._test_message = None
+        self._publish_queue = Queue(maxsize=self.queue_size)
+        self._queue_high_water = 0
+        # frames dropped by the reader thread and by the publisher thread,
+        # each only written by its own thread
+        self._dropped_frames = 0
+        self._publish_dropped_frames = 0
+        self._publish_errors = 0
+        self._latency = LatencyStats()
         self._running = False
+        self._shut_down = False
         self._callbacks()
 
         self._setup_bus()
@@ -44,33 +68,153 @@ class CanReader:
             help="Socket.IO server to use",
         )
         parser.add_argument(
-            "--batch_size", default=10, help="Size of batches to send can frames"
+            "--batch_size",
+            default=10,
+            help="Maximum size of batches to send can frames",
+        )
+        parser.add_argument(
+            "--batch_age",
+            default=0.02,
+            help="Maximum seconds a frame may wait in a batch before publishing",
+        )
+        parser.add_argument(
+            "--publish_rate",
+            default=100,
+            help="Target batches per second, used to size batches to the bus rate",
+        )
+        parser.add_argument(
+            "--queue_size",
+            default=1000,
+            help="Maximum batches waiting to be published before frames are dropped",
         )
         parser.add_argument(
             "--test", action="store_true", help="Run in test mode (no can device)"
         )
+        parser.add_argument(
+            "--test_speed",
+            default=1.0,
+            help="Test data replay speed multiplier, 0 replays as fast as possible",
+        )
+        parser.add_argument(
+            "--test_source",
+            default="asc",
+            choices=["asc", "synthetic"],
+            help="Replay test_data/<channel>_cleaned.asc or generate traffic from the dbc",
+        )
+        parser.add_argument(
+            "--test_duration",
+            default=None,
+            help="Seconds of synthetic traffic to generate (default: endless)",
+        )
+        parser.add_argument(
+            "--test_bus_load",
+            default=None,
+            help="Synthetic bus load, 0 to 1 (default: cfg.synthetic_bus_load)",
+        )
+        parser.add_argument(
+            "--test_bitrate",
+            default=500000,
+            help="Bitrate the synthetic bus load is relative to",
+        )
+        parser.add_argument(
+            "--test_seed",
+            default=None,
+            help="Seed for synthetic traffic, for repeatable runs",
+        )
+        parser.add_argument(
+            "--test_start",
+            default=None,
+            help="Shared wall clock start of the replay (set by main.py)",
+        )
+        parser.add_argument(
+            "--test_channels",
+            default=None,
+            help="Comma separated channels replayed together, kept time aligned",
+        )
 
         args = parser.parse_args()
         self.channel = args.channel
+        self.channel_index = channel2int(self.channel) or 0
         self.bustype = args.bustype
         self.server_address = args.server
         self.batch_size = int(args.batch_size)
-        if self.batch_size < 1:
-            raise Exception("batch_size must be greater than 0")
+        if not 0 < self.batch_size <= frame_batch.MAX_FRAMES:
+            raise Exception(
+                f"batch_size must be between 1 and {frame_batch.MAX_FRAMES}"
+            )
+        self.max_batch_age = float(args.batch_age)
+        if self.max_batch_age <= 0:
+            raise Exception("batch_age must be greater than 0")
+        self.publish_rate = float(args.publish_rate)
+        if self.publish_rate <= 0:
+            raise Exception("publish_rate must be greater than 0")
+        self.queue_size = int(args.queue_size)
+        if self.queue_size < 1:
+            raise Exception("queue_size must be greater than 0")
         self.testing = args.test
+        self.test_speed = float(args.test_speed)
+        if self.test_speed < 0:
+            raise Exception("test_speed must not be negative")
+        self.test_source = args.test_source
+        self.test_duration = float(args.test_duration) if args.test_duration else None
+        self.test_bus_load = (
+            float(args.test_bus_load)
+            if args.test_bus_load is not None
+            else cfg.synthetic_bus_load
+        )
+        self.test_bitrate = int(args.test_bitrate)
+        self.test_seed = int(args.test_seed) if args.test_seed is not None else None
+        self.test_start = float(args.test_start) if args.test_start else None
+        self.test_channels = (
+            args.test_channels.split(",") if args.test_channels else [self.channel]
+        )
 
     def _setup_bus(self):
         if self.testing:
-            self.reader = iter(
-                ASCReader(
-                    f"test_data/{self.channel}_cleaned.asc", relative_timestamp=False
+            if self.test_source == "synthetic":
+                self.reader = iter(self._synthetic_traffic())
+            else:
+                self.reader = iter(
+                    ASCReader(
+                        f"test_data/{self.channel}_cleaned.asc",
+                        relative_timestamp=False,
+                    )
                 )
+            self._test_message = next(self.reader)
+            self._replay_clock = ReplayClock(
+                self.red,
+                self.channel,
+                self._test_message.timestamp,
+                speed=self.test_speed,
+                start=self.test_start,
+                channels=self.test_channels,
             )
-            self._test_time_offset = time() - next(self.reader).timestamp
-            self._test_start_time = time()
+            self._test_start_time = self._replay_clock.start
+            self._test_frame_count = 0
+            self._last_replayed_until = self._replay_clock.origin
         else:
             self.bus = can.interface.Bus(channel=self.channel, bustype=self.bustype)
 
+    def _synthetic_traffic(self):
+        include = []
+        if self.channel == cfg.synthetic_filtered_channel:
+            include = cfg.can_filter
+        traffic = SyntheticTraffic(
+            cantools.db.load_file(cfg.dbc_file),
+            channel=self.channel_index,
+            include=include,
+            rates=cfg.synthetic_rates,
+            bus_load=self.test_bus_load,
+            bitrate=self.test_bitrate,
+            start=self.test_start,
+            duration=self.test_duration,
+            seed=self.test_seed,
+        )
+        self.logger.info(
+            f"generating synthetic traffic at {traffic.bus_load:.0%} bus load"
+        )
+        return traffic
+
     def run(self):
         try:
             self.sio.connect(
@@ -79,13 +223,21 @@ class CanReader:
                 wait_timeout=60,
             )
             self._running = True
+            self._publisher_thread = Thread(target=self._publisher_task, daemon=True)
+            self._publisher_thread.start()
             self._stats_thread = Thread(target=self._stats_publisher_task, daemon=True)
             self._stats_thread.start()
 
             while self._running:
-                self._add_message_to_batch()
-                if len(self._msg_batch) >= self.batch_size:
-                    self._publish_batch()
+                if self._msg_batch:
+                    timeout = max(self._batch_deadline - time(), 0)
+                else:
+                    timeout = 1
+                self._add_message_to_batch(timeout)
+                if len(self._msg_batch) >= self._target_batch_size:
+                    self._publish_batch("size")
+                elif self._msg_batch and time() >= self._batch_deadline:
+                    self._publish_batch("age")
 
         except KeyboardInterrupt:
             pass
@@ -95,34 +247,112 @@ class CanReader:
             self.shutdown()
 
     def shutdown(self):
+        # also called from the reader loop when test data runs out
+        if self._shut_down:
+            return
+        self._shut_down = True
+        if self._msg_batch:
+            self._hand_off(self._msg_batch)
+            self._msg_batch = []
         self._running = False
+        self._publisher_thread.join(timeout=2)
         self._stats_thread.join(timeout=2)
         self.sio.disconnect()
 
-    def _add_message_to_batch(self):
+    def _add_message_to_batch(self, timeout):
         if self.testing:
+            message = self._next_test_message(timeout)
+        else:
+            message = self.bus.recv(timeout=timeout)
+        if message:
+            if not self._msg_batch:
+                self._batch_deadline = time() + self.max_batch_age
+            self._msg_batch.append(message)
+            self.frame_count += 1
+
+    def _next_test_message(self, timeout):
+        if self._test_message is None:
             try:
-                message = next(self.reader)
-                sleep_time = (message.timestamp + self._test_time_offset) - time()
-                if sleep_time > 0:
-                    sleep(sleep_time)
+                self._test_message = next(self.reader)
             except StopIteration:
+                self._replay_clock.finish()
                 test_time = time() - self._test_start_time
-                self.logger.info(f"test data complete after {test_time:.2f} seconds")
+                data_time = (
+                    self._replay_clock.replayed_until - self._replay_clock.origin
+                )
+                self.logger.info(
+                    f"test data complete after {test_time:.2f} seconds: "
+                    f"{self._test_frame_count} frames, "
+                    f"{self._test_frame_count / test_time:.0f} fps, "
+                    f"{data_time / test_time:.2f}x realtime"
+                )
                 sleep(1)
                 self.shutdown()
-                return
-        else:
-            message = self.bus.recv(timeout=1)
-        if message:
-            self._msg_batch.append(message)
-            self.frame_count += 1
+                return None
+        deadline = time() + timeout
+        delay = self._replay_clock.delay(self._test_message.timestamp)
+        while delay > 0:
+            remaining = deadline - time()
+            if delay > remaining:
+                sleep(max(remaining, 0))
+                return None
+            sleep(delay)
+            delay = self._replay_clock.delay(self._test_message.timestamp)
+        message = self._test_message
+        self._test_message = None
+        self._replay_clock.emitted(message.timestamp)
+        self._test_frame_count += 1
+        return message
 
-    def _publish_batch(self):
-        pickled_batch = pickle.dumps(self._msg_batch)
-        self.red.publish(f"{self.channel}_frame_batch", pickled_batch)
+    def _publish_batch(self, reason):
+        self._hand_off(self._msg_batch)
+        self._flush_counts[reason] += 1
+        self._batch_fill_sum += len(self._msg_batch) / self._target_batch_size
         self._msg_batch = []
 
+    def _hand_off(self, batch):
+        # never block the bus reader, drop the batch if the publisher is behind
+        try:
+            self._publish_queue.put_nowait(batch)
+        except Full:
+            self._dropped_frames += len(batch)
+            return
+        depth = self._publish_queue.qsize()
+        if depth > self._queue_high_water:
+            self._queue_high_water = depth
+
+    def _publisher_task(self):
+        channel = f"{self.channel}_frame_batch"
+        while self._running or not self._publish_queue.empty():
+            try:
+                batch = self._publish_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                packed_batch = frame_batch.pack_messages(batch, self.channel_index)
+                if cfg.trace_latency:
+                    now = time()
+                    packed_batch = frame_batch.add_publish_time(packed_batch, now)
+                    self._latency.add(
+                        f"{self.channel} publish latency",
+                        frame_ages(packed_batch, now),
+                    )
+                self.red.publish(channel, packed_batch)
+            except redis.RedisError as e:
+                if not self._publish_errors:
+                    self.logger.warning(f"Failed to publish frame batch: {e}")
+                self._publish_errors += 1
+                self._publish_dropped_frames += len(batch)
+
+    def _adapt_batch_size(self, fps):
+        # smooth the observed rate so a single quiet second doesn't collapse batches
+        if self._rate_estimate is None:
+            self._rate_estimate = fps
+        else:
+            self._rate_estimate = 0.7 * self._rate_estimate + 0.3 * fps
+        target = int(self._rate_estimate / self.publish_rate)
+        self._target_batch_size = min(max(target, 1), self.batch_size)
+
     def _stats_publisher_task(self):
         while self._running:
             sleep(1)
@@ -132,10 +362,48 @@ class CanReader:
         now = time()
         delta = now - self.count_start
         fps = int(self.frame_count / delta)
-        if self.sio.connected:
-            self.sio.emit("broadcast_stats", {"fps": {f"{self.channel} rx": fps}})
+        flushes = sum(self._flush_counts.values())
+        fill = 100 * self._batch_fill_sum / flushes if flushes else 0
+        system = {
+            f"{self.channel} batch size": {"value": self._target_batch_size},
+            f"{self.channel} batch fill": {
+                "value": round(fill),
+                "unit": "%",
+            },
+            f"{self.channel} size flushes": {
+                "value": round(self._flush_counts["size"] / delta, 1),
+                "unit": "/s",
+            },
+            f"{self.channel} age flushes": {
+                "value": round(self._flush_counts["age"] / delta, 1),
+                "unit": "/s",
+            },
+            f"{self.channel} publish queue": {"value": self._publish_queue.qsize()},
+            f"{self.channel} publish queue max": {"value": self._queue_high_water},
+            f"{self.channel} rx dropped": {
+                "value": self._dropped_frames + self._publish_dropped_frames
+            },
+            f"{self.channel} publish errors": {"value": self._publish_errors},
+            **self._latency.stats(),
+        }
+        if self.testing:
+            replayed_until = self._replay_clock.replayed_until
+            speed = (replayed_until - self._last_replayed_until) / delta
+            self._last_replayed_until = replayed_until
+            system[f"{self.channel} replay speed"] = {
+                "value": round(speed, 2),
+                "unit": "x",
+            }
+        # one event per tick, snapshot.py keeps only the last stats per emitter
+        self.emitter.emit(
+            "stats", {"fps": {f"{self.channel} rx": fps}, "system": system}
+        )
+        self._adapt_batch_size(fps)
+        self._latency.reset()
         self.count_start = now
         self.frame_count = 0
+        self._flush_counts = {"size": 0, "age": 0}
+        self._batch_fill_sum = 0.0
 
     def _callbacks(self):
         @self.sio.event
@@ -147,6 +415,10 @@ class CanReader:
             now = time()
             self.count_start = now
             self.frame_count = 0
+            self._flush_counts = {"size": 0, "age": 0}
+            self._batch_fill_sum = 0.0
+            if self._msg_batch:
+                self._batch_deadline = now
 
 
 if __name__ == "__main__":
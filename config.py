@@ -29,6 +29,98 @@ can_filter = [
     "ID528UnixTime",
 ]
 
+# Messages to decode at every frame instead of once per decode_interval.
+# Samples are published to redis on "<frame id>_samples" (e.g. "175_samples")
+# as numpy records, see BatchDecoder.dtype in batch_decoder.py. Only useful with
+# something subscribed to them, e.g. ["ID129SteeringAngle", "ID175WheelSpeed"]
+sample_filter = []
+
+# Raw log format: "asc" (text, readable by most tools) or "bin" (compact fixed-width
+# records, several times smaller, convert with: python frame_log.py <file>.canlog)
+log_format = "asc"
+# Seconds between fsyncs of the open log, 0 leaves it to the OS. Its .idx index is saved
+# on every fsync (every 5 s with 0), so a log cut short by power loss keeps an index
+log_fsync_interval = 5
+
+# Synthetic traffic for testing without a car (main.py --test --test_source synthetic).
+# Messages in can_filter are sent on this channel with random walk signals at their
+# dbc cycle time, or the rate (Hz) given here, or 10 Hz. Other dbc messages fill
+# each bus up to synthetic_bus_load (1.0 = 100% of 500 kbit/s).
+synthetic_filtered_channel = "can0"
+synthetic_bus_load = 0.5
+synthetic_rates = {
+    "ID101RCM_inertial1": 100,
+    "ID108DIR_torque": 100,
+    "ID111RCM_inertial2": 100,
+    "ID118DriveSystemStatus": 100,
+    "ID129SteeringAngle": 100,
+    "ID132HVBattAmpVolt": 100,
+    "ID155WheelAngles": 100,
+    "ID175WheelSpeed": 100,
+    "ID185ESP_brakeTorque": 100,
+    "ID186DIF_torque": 100,
+    "ID257DIspeed": 50,
+    "ID528UnixTime": 1,
+}
+
+# Redis url of the socket.io message queue, processes emit events to the web clients
+# through it directly instead of via server.py ("" to relay everything via server.py)
+sio_message_queue = "redis://localhost:6379/0"
+
+# How decoded values reach the web UI: "legacy" sends every client the full vehicle_stats
+# dict, "delta" sends the web UI only changed values (see vehicle_stream.py) with a full
+# snapshot every vehicle_snapshot_interval seconds. "delta" needs sio_message_queue.
+vehicle_stream = "delta"
+vehicle_snapshot_interval = 10
+# Send delta updates as msgpack instead of json (pip install msgpack)
+vehicle_stream_msgpack = False
+
+# Named sets of signals web clients can subscribe to (index.html?dashboard=driving),
+# as messages from can_filter or "<message>.<signal>", see subscriptions.py.
+# Only subscribed signals are decoded.
+dashboards = {
+    "driving": [
+        "ID257DIspeed",
+        "ID118DriveSystemStatus.DI_gear",
+        "ID129SteeringAngle",
+        "ID132HVBattAmpVolt",
+        "ID33AUI_rangeSOC",
+    ],
+    "thermal": [
+        "ID20CVCRIGHT_hvacRequest",
+        "ID243VCRIGHT_hvacStatus",
+    ],
+}
+
+# Clients get the last stats and signal values on connect (see snapshot.py),
+# leaving out those older than this many seconds
+snapshot_max_age = 10
+
+# Live charts (public/plot.html, see plot_stream.py): seconds between plot updates,
+# max samples/s per signal and max signals per chart
+plot_interval = 0.05
+plot_max_rate = 500
+plot_max_signals = 8
+
+# Messages whose signals are stored at full rate, with 1 s and 1 min min/max/mean
+# rollups, for charting whole drives (see timeseries.py). Raw samples take 12 bytes,
+# so a 100 Hz message with 10 signals needs about 40 MB per hour of driving:
+timeseries_filter = []
+timeseries_dir = "/tmp/canserver-logs/timeseries"
+
+# Measure the latency of every hop frames take (rx, redis, decode, panda udp) and show
+# percentiles in the system stats. Costs a little cpu per batch, see latency.py
+trace_latency = False
+
+# Panda clients (panda_server.py) get their own send queue, and frames beyond these
+# limits wait in it. Max frames/s by client ip, "default" for the rest (0 = unlimited):
+panda_client_max_fps = {"default": 0}
+# Max rate (Hz) of some frame ids to all panda clients, e.g. {"257": 10}
+panda_id_max_rate = {}
+# Datagrams (up to 92 frames each) queued per client, the oldest is dropped when full.
+# Rate limited clients queue at most 1 s of their max fps, so they don't fall behind.
+panda_client_queue_size = 64
+
 # If you have a pican DUO:
 pican_duo = True
 
@@ -52,3 +144,10 @@ flag_log_signal_name = "SCCM_highBeamStalkStatus"
 flag_log_state = "PUSH"
 # Only flag when holding the signal for at least this duration
 flag_log_signal_duration = 0.8
+# Flagging while not logging starts a log that stops after this many seconds
+flag_log_post_trigger_seconds = 30
+
+# Seconds of frames kept in memory (per channel) while not logging, and written
+# at the start of every new log so it includes the moments before it started
+pre_trigger_seconds = 10
+pre_trigger_max_bytes = 8 * 1024 * 1024
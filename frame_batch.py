@@ -0,0 +1,140 @@
+"""Binary wire format for batches of CAN frames published on redis.
+
+A batch is a fixed header followed by fixed-width records (little endian):
+
+    header: version (u8), channel (u8), frame count (u16)
+    record: timestamp (f64), arbitration id (u32), flags (u8), dlc (u8),
+            data (8 bytes, zero padded past dlc)
+
+With cfg.trace_latency the rx client appends the time the batch was
+published (f64) after the records, readers that don't trace ignore it.
+
+Unpacked frames are plain tuples in record order:
+(timestamp, arbitration_id, flags, dlc, data)
+"""
+
+import struct
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+from can import Message
+
+VERSION = 1
+
+HEADER = struct.Struct("<BBH")
+RECORD = struct.Struct("<dIBB8s")
+TRACE = struct.Struct("<d")
+
+MAX_FRAMES = 0xFFFF
+
+# numpy view of RECORD, for reading whole batches as columns
+FRAME_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("arbitration_id", "<u4"),
+        ("flags", "u1"),
+        ("dlc", "u1"),
+        ("data", "u1", (8,)),
+    ]
+)
+
+FLAG_EXTENDED_ID = 0x01
+FLAG_REMOTE_FRAME = 0x02
+FLAG_ERROR_FRAME = 0x04
+
+Frame = Tuple[float, int, int, int, bytes]
+
+
+def message_flags(msg: Message) -> int:
+    flags = 0
+    if msg.is_extended_id:
+        flags |= FLAG_EXTENDED_ID
+    if msg.is_remote_frame:
+        flags |= FLAG_REMOTE_FRAME
+    if msg.is_error_frame:
+        flags |= FLAG_ERROR_FRAME
+    return flags
+
+
+def pack_messages(messages: Iterable[Message], channel: int) -> bytes:
+    messages = list(messages)
+    if len(messages) > MAX_FRAMES:
+        raise ValueError(f"batch of {len(messages)} frames exceeds {MAX_FRAMES}")
+    buf = bytearray(HEADER.size + RECORD.size * len(messages))
+    HEADER.pack_into(buf, 0, VERSION, channel, len(messages))
+    offset = HEADER.size
+    for msg in messages:
+        RECORD.pack_into(
+            buf,
+            offset,
+            msg.timestamp,
+            msg.arbitration_id,
+            message_flags(msg),
+            msg.dlc,
+            bytes(msg.data),
+        )
+        offset += RECORD.size
+    return bytes(buf)
+
+
+def pack_frames(frames: Iterable[Frame], channel: int) -> bytes:
+    frames = list(frames)
+    if len(frames) > MAX_FRAMES:
+        raise ValueError(f"batch of {len(frames)} frames exceeds {MAX_FRAMES}")
+    buf = bytearray(HEADER.size + RECORD.size * len(frames))
+    HEADER.pack_into(buf, 0, VERSION, channel, len(frames))
+    offset = HEADER.size
+    for frame in frames:
+        RECORD.pack_into(buf, offset, *frame)
+        offset += RECORD.size
+    return bytes(buf)
+
+
+def unpack_header(buf: bytes) -> Tuple[int, int]:
+    """Return (channel, frame count) of a packed batch."""
+    version, channel, count = HEADER.unpack_from(buf, 0)
+    if version != VERSION:
+        raise ValueError(f"unsupported frame batch version {version}")
+    if len(buf) < HEADER.size + count * RECORD.size:
+        raise ValueError("truncated frame batch")
+    return channel, count
+
+
+def unpack(buf: bytes) -> Tuple[int, Iterator[Frame]]:
+    """Return the channel and an iterator of frame tuples, read in place."""
+    channel, count = unpack_header(buf)
+    end = HEADER.size + count * RECORD.size
+    return channel, RECORD.iter_unpack(memoryview(buf)[HEADER.size : end])
+
+
+def add_publish_time(buf: bytes, publish_time: float) -> bytes:
+    return buf + TRACE.pack(publish_time)
+
+
+def publish_time(buf: bytes) -> Optional[float]:
+    """Return the publish time appended to a traced batch, else None."""
+    _, count = unpack_header(buf)
+    end = HEADER.size + count * RECORD.size
+    if len(buf) < end + TRACE.size:
+        return None
+    return TRACE.unpack_from(buf, end)[0]
+
+
+def to_array(buf: bytes) -> np.ndarray:
+    """Return the frames of a packed batch as a read-only FRAME_DTYPE array."""
+    _, count = unpack_header(buf)
+    return np.frombuffer(buf, dtype=FRAME_DTYPE, count=count, offset=HEADER.size)
+
+
+def to_message(frame: Frame, channel: int) -> Message:
+    timestamp, arbitration_id, flags, dlc, data = frame
+    return Message(
+        timestamp=timestamp,
+        arbitration_id=arbitration_id,
+        is_extended_id=bool(flags & FLAG_EXTENDED_ID),
+        is_remote_frame=bool(flags & FLAG_REMOTE_FRAME),
+        is_error_frame=bool(flags & FLAG_ERROR_FRAME),
+        dlc=dlc,
+        data=data[:dlc],
+        channel=channel,
+    )
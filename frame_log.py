@@ -0,0 +1,294 @@
+"""Log writers used by can_logger_client.py, and a binary log to ASC converter.
+
+The binary log (".canlog") is a 16 byte file header followed by the same
+fixed-width records as frame_batch.RECORD, in arrival order:
+
+    header: magic b"CANFRLOG", version (u8), channel (u8), 6 reserved bytes
+    record: timestamp (f64), arbitration id (u32), flags (u8), dlc (u8),
+            data (8 bytes, zero padded past dlc)
+
+Batches from redis are appended without unpacking and written in whole
+64 KiB blocks, so a logged frame costs 22 bytes and no per-frame Python
+work. A record cut short by power loss at the end of the file is ignored
+on read.
+
+Every writer also records a sidecar index (see log_index.py), saved as
+"<log>.idx" on every sync and when the writer stops, so a log cut short by
+power loss still has an index of everything synced.
+
+Writers are driven by AsyncLogWriter, which owns a writer thread so that
+logging never runs on the redis pubsub thread.
+
+Convert to ASC with: python frame_log.py <file>.canlog [-o <file>.asc]
+"""
+
+import logging
+import os
+import struct
+from argparse import ArgumentParser
+from collections import deque
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import time
+from typing import Iterator, List, Tuple
+
+from can import ASCWriter
+
+import frame_batch
+import log_index
+
+MAGIC = b"CANFRLOG"
+VERSION = 1
+FILE_HEADER = struct.Struct("<8sBB6x")
+EXTENSIONS = {"asc": ".asc", "bin": ".canlog"}
+
+_WRITE_BLOCK = 64 * 1024
+_READ_CHUNK = frame_batch.RECORD.size * 4096
+_COALESCE_BATCHES = 256
+# seconds between index saves when the log is not fsynced
+_INDEX_INTERVAL = 5
+
+_STOP = object()
+
+
+class BinaryLogWriter:
+    def __init__(self, file_path: str, channel: int) -> None:
+        self.file_path = file_path
+        self.index = log_index.LogIndex("bin", channel)
+        self._file = open(file_path, "wb")
+        self._pending = bytearray(FILE_HEADER.pack(MAGIC, VERSION, channel))
+        self._offset = len(self._pending)
+
+    def write_batches(self, packed_batches: List[bytes]) -> None:
+        pending = self._pending
+        start = frame_batch.HEADER.size
+        for packed_batch in packed_batches:
+            _, count = frame_batch.unpack_header(packed_batch)
+            size = count * frame_batch.RECORD.size
+            pending += memoryview(packed_batch)[start : start + size]
+            self.index.add_records(frame_batch.to_array(packed_batch), self._offset)
+            self._offset += size
+        if len(pending) >= _WRITE_BLOCK:
+            size = len(pending) - len(pending) % _WRITE_BLOCK
+            self._file.write(pending[:size])
+            del pending[:size]
+
+    def sync(self, fsync: bool = True) -> None:
+        """Write out the log, then save the index of what was written."""
+        self._file.write(self._pending)
+        self._pending.clear()
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self.index.save(log_index.index_path(self.file_path))
+
+    def stop(self) -> None:
+        self.sync()
+        self._file.close()
+
+
+class AscLogWriter:
+    def __init__(self, file_path: str, channel: int) -> None:
+        self.file_path = file_path
+        self.index = log_index.LogIndex("asc", channel)
+        self._writer = ASCWriter(file_path)
+
+    def write_batches(self, packed_batches: List[bytes]) -> None:
+        on_message_received = self._writer.on_message_received
+        add_to_index = self.index.add_frame
+        tell = self._writer.file.tell
+        for packed_batch in packed_batches:
+            channel, frames = frame_batch.unpack(packed_batch)
+            for frame in frames:
+                add_to_index(frame[0], frame[1], tell)
+                on_message_received(frame_batch.to_message(frame, channel))
+
+    def sync(self, fsync: bool = True) -> None:
+        """Write out the log, then save the index of what was written."""
+        self._writer.file.flush()
+        if fsync:
+            os.fsync(self._writer.file.fileno())
+        self.index.time_origin = self._writer.started
+        self.index.save(log_index.index_path(self.file_path))
+
+    def stop(self) -> None:
+        self.index.time_origin = self._writer.started
+        self._writer.stop()
+        self.index.save(log_index.index_path(self.file_path))
+
+
+WRITERS = {"asc": AscLogWriter, "bin": BinaryLogWriter}
+
+
+class AsyncLogWriter:
+    """Feeds a log writer from a bounded queue on its own thread.
+
+    write_batch() never blocks: when the queue is full the batch is dropped
+    and counted. stop() returns only after every batch accepted before it
+    has been written and the file is closed, so the file can be moved right
+    after. Batches offered after stop() are ignored.
+    """
+
+    def __init__(
+        self, writer, queue_size: int = 1000, fsync_interval: float = 0
+    ) -> None:
+        self.writer = writer
+        self.file_path = writer.file_path
+        self.dropped_frames = 0
+        self.write_errors = 0
+        self._fsync_interval = fsync_interval
+        self._logger = logging.getLogger(
+            f"frame_log.{os.path.basename(self.file_path)}"
+        )
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def write_batch(self, packed_batch: bytes) -> int:
+        _, count = frame_batch.unpack_header(packed_batch)
+        with self._lock:
+            if self._stopped:
+                return 0
+            try:
+                self._queue.put_nowait(packed_batch)
+            except Full:
+                self.dropped_frames += count
+                return 0
+        return count
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        # the index is saved on every sync, also when not fsyncing
+        sync_interval = self._fsync_interval or _INDEX_INTERVAL
+        last_sync = time()
+        stopping = False
+        while not stopping:
+            batches = [self._queue.get()]
+            # coalesce everything already waiting into one write
+            while len(batches) < _COALESCE_BATCHES and batches[-1] is not _STOP:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if batches[-1] is _STOP:
+                batches.pop()
+                stopping = True
+            try:
+                if batches:
+                    self.writer.write_batches(batches)
+                if not stopping and time() >= last_sync + sync_interval:
+                    self.writer.sync(fsync=bool(self._fsync_interval))
+                    last_sync = time()
+            except Exception as e:
+                if not self.write_errors:
+                    self._logger.exception(e)
+                self.write_errors += 1
+        try:
+            self.writer.stop()
+        except Exception as e:
+            self._logger.exception(e)
+
+
+class PreTriggerBuffer:
+    """The last few seconds of packed batches, bounded by age and by bytes.
+
+    Batches are kept exactly as received from redis (22 bytes per frame), so
+    they can be handed straight to a log writer when a log starts.
+    """
+
+    def __init__(self, seconds: float, max_bytes: int) -> None:
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._batches = deque()
+
+    def append(self, packed_batch: bytes, now: float) -> None:
+        if self.seconds <= 0:
+            return
+        batches = self._batches
+        batches.append((now, packed_batch))
+        self.size += len(packed_batch)
+        cutoff = now - self.seconds
+        while batches and (self.size > self.max_bytes or batches[0][0] < cutoff):
+            self.size -= len(batches.popleft()[1])
+
+    def drain(self) -> List[bytes]:
+        batches = [packed_batch for _, packed_batch in self._batches]
+        self.clear()
+        return batches
+
+    def clear(self) -> None:
+        self._batches = deque()
+        self.size = 0
+
+
+def read_binary_log(file_path: str) -> Tuple[int, Iterator[frame_batch.Frame]]:
+    """Return the channel and an iterator of frame tuples from a binary log."""
+    file = open(file_path, "rb")
+    header = file.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        file.close()
+        raise ValueError(f"{file_path} is not a binary can log")
+    magic, version, channel = FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        file.close()
+        raise ValueError(f"{file_path} is not a binary can log")
+    if version != VERSION:
+        file.close()
+        raise ValueError(f"unsupported binary can log version {version}")
+
+    def frames():
+        with file:
+            while True:
+                chunk = file.read(_READ_CHUNK)
+                usable = len(chunk) - len(chunk) % frame_batch.RECORD.size
+                if usable:
+                    yield from frame_batch.RECORD.iter_unpack(chunk[:usable])
+                if len(chunk) < _READ_CHUNK:
+                    return
+
+    return channel, frames()
+
+
+def convert_to_asc(file_path: str, asc_path: str) -> int:
+    channel, frames = read_binary_log(file_path)
+    writer = ASCWriter(asc_path)
+    count = 0
+    try:
+        for frame in frames:
+            writer.on_message_received(frame_batch.to_message(frame, channel))
+            count += 1
+    finally:
+        writer.stop()
+    return count
+
+
+def main():
+    parser = ArgumentParser(description="Convert a binary can log to ASC")
+    parser.add_argument("log", help="Binary log (.canlog) to convert")
+    parser.add_argument(
+        "--output", "-o", help="ASC file to write (default: log name with .asc)"
+    )
+    args = parser.parse_args()
+    output = args.output
+    if not output:
+        output = args.log.rsplit(".", 1)[0] + EXTENSIONS["asc"]
+    count = convert_to_asc(args.log, output)
+    print(f"wrote {count} frames to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from threading import Lock
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+from frame_batch import Frame
+
+
+class LatestFrameTable:
+    """Newest frame per key, plus the keys that changed since the last drain.
+
+    Keys are arbitration ids, or (channel, arbitration id) when update() is
+    given a channel. Memory is bounded by the number of distinct keys.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._latest: Dict[Hashable, Frame] = {}
+        self._dirty = set()
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def update(self, frames: Iterable[Frame], channel: int = None) -> int:
+        count = 0
+        with self._lock:
+            latest = self._latest
+            dirty = self._dirty
+            for frame in frames:
+                key = frame[1] if channel is None else (channel, frame[1])
+                current = latest.get(key)
+                if current is None or frame[0] >= current[0]:
+                    latest[key] = frame
+                    dirty.add(key)
+                count += 1
+        return count
+
+    def drain(self) -> List[Tuple[Hashable, Frame]]:
+        """Return (key, frame) for every key updated since the last drain."""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            latest = self._latest
+            return [(key, latest[key]) for key in dirty]
+
+    def mark_dirty(self, keys: Iterable[Hashable]) -> None:
+        """Have the next drain return these keys again, e.g. for frames that
+        were drained but held back."""
+        with self._lock:
+            self._dirty.update(key for key in keys if key in self._latest)
+
+    def get(self, key: Hashable) -> Frame:
+        return self._latest.get(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._latest = {}
+            self._dirty = set()
@@ -0,0 +1,106 @@
+"""Log-bucketed latency histograms, reported through broadcast_stats.
+
+With cfg.trace_latency (or --frame_latency, which benchmark.py passes)
+every consumer measures the age of frames as they arrive ("<stage> latency",
+bus to consumer). With cfg.trace_latency the hops in between are measured
+too, each as "<stage> <hop> latency":
+
+    <can> publish   bus receive -> redis publish (batching and queueing)
+    <stage> redis   redis publish -> consumer receive
+    decoder emit    bus receive -> vehicle_stats emit
+    panda send      bus receive -> udp send
+
+Buckets are 10 per decade from 10 us to 100 s, so percentiles are accurate
+to about 25% at any scale and adding a whole batch of samples is a single
+numpy searchsorted.
+"""
+
+from typing import Dict, Union
+
+import numpy as np
+
+import frame_batch
+
+_EDGES = np.logspace(-5, 2, 71)
+
+
+def frame_ages(packed_batch: bytes, now: float) -> np.ndarray:
+    """Seconds since each frame of a packed batch was read from the bus."""
+    return now - frame_batch.to_array(packed_batch)["timestamp"]
+
+
+class LatencyHistogram:
+    def __init__(self) -> None:
+        self.counts = np.zeros(len(_EDGES) + 1, dtype=np.int64)
+        self.max = 0.0
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, latency: float) -> None:
+        self.counts[np.searchsorted(_EDGES, latency)] += 1
+        if latency > self.max:
+            self.max = latency
+
+    def add_many(self, latencies: np.ndarray) -> None:
+        if not len(latencies):
+            return
+        buckets = np.searchsorted(_EDGES, latencies)
+        self.counts += np.bincount(buckets, minlength=len(self.counts))
+        self.max = max(self.max, float(latencies.max()))
+
+    def percentile(self, q: float) -> float:
+        """Upper edge of the bucket holding the q-th (0-100) percentile, in s."""
+        total = self.counts.sum()
+        if not total:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), total * q / 100))
+        if bucket >= len(_EDGES):
+            return self.max
+        return min(float(_EDGES[bucket]), self.max)
+
+    def stats(self, name: str) -> Dict[str, dict]:
+        """system_stats entries for this histogram, in milliseconds."""
+        if not self.count:
+            return {}
+        return {
+            f"{name} p50": {
+                "value": round(self.percentile(50) * 1000, 2),
+                "unit": "ms",
+            },
+            f"{name} p99": {
+                "value": round(self.percentile(99) * 1000, 2),
+                "unit": "ms",
+            },
+        }
+
+    def reset(self) -> None:
+        self.counts[:] = 0
+        self.max = 0.0
+
+
+class LatencyStats:
+    """Named histograms of one process, published and reset together."""
+
+    def __init__(self) -> None:
+        self._histograms: Dict[str, LatencyHistogram] = {}
+
+    def add(self, name: str, latencies: Union[float, np.ndarray]) -> None:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        if isinstance(latencies, np.ndarray):
+            histogram.add_many(latencies)
+        else:
+            histogram.add(latencies)
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {}
+        for name, histogram in list(self._histograms.items()):
+            stats.update(histogram.stats(name))
+        return stats
+
+    def reset(self) -> None:
+        for histogram in list(self._histograms.values()):
+            histogram.reset()
@@ -0,0 +1,320 @@
+"""Sidecar time/id index for raw logs, and a CLI to pull frames out of them.
+
+While a log is written, its writer feeds a LogIndex which is saved next to
+the log as "<log>.idx" (JSON) every few seconds and when the log is closed. The index splits the
+log into time buckets (1 second by default) and keeps for each bucket the
+byte offset of its first frame, its frame count and the ids it contains,
+plus total frame counts per id. Queries read only the buckets that overlap
+the time window and contain a wanted id, so the work done follows the
+size of the result, not the size of the log.
+
+Usage:
+    python log_index.py <log>                       summary of the log
+    python log_index.py <log> --start 60 --end 90 --ids 118,257 -o out.canlog
+    python log_index.py <log> --rebuild             (re)create a missing index
+
+--start/--end are seconds from the start of the log. The output format
+(.asc or .canlog) follows the output file extension.
+"""
+
+import json
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import frame_batch
+import frame_log
+
+VERSION = 1
+EXTENSION = ".idx"
+
+
+class LogIndex:
+    def __init__(self, log_format: str, channel: int, bucket_seconds: float = 1.0):
+        self.log_format = log_format
+        self.channel = channel
+        self.bucket_seconds = bucket_seconds
+        # asc timestamps are written relative to this
+        self.time_origin = 0.0
+        # [bucket number, byte offset, frame count, ids]
+        self.buckets: List[list] = []
+        self.id_counts: Dict[int, int] = {}
+
+    @property
+    def start(self) -> Optional[float]:
+        if not self.buckets:
+            return None
+        return min(b[0] for b in self.buckets) * self.bucket_seconds
+
+    def add_frame(self, timestamp: float, arbitration_id: int, tell) -> None:
+        """Index one frame, tell() returns its byte offset and is only called
+        when the frame opens a new bucket."""
+        bucket = int(timestamp // self.bucket_seconds)
+        if not self.buckets or self.buckets[-1][0] != bucket:
+            self.buckets.append([bucket, tell(), 0, set()])
+        current = self.buckets[-1]
+        current[2] += 1
+        current[3].add(arbitration_id)
+        self.id_counts[arbitration_id] = self.id_counts.get(arbitration_id, 0) + 1
+
+    def add_records(self, frames: np.ndarray, first_offset: int) -> None:
+        """Index consecutive fixed-width records, the first at first_offset."""
+        if not len(frames):
+            return
+        buckets = (frames["timestamp"] // self.bucket_seconds).astype(np.int64)
+        ids = frames["arbitration_id"]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.append(starts[1:], len(frames))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            bucket = int(buckets[start])
+            if not self.buckets or self.buckets[-1][0] != bucket:
+                offset = first_offset + start * frame_batch.RECORD.size
+                self.buckets.append([bucket, offset, 0, set()])
+            current = self.buckets[-1]
+            current[2] += end - start
+            current[3].update(np.unique(ids[start:end]).tolist())
+        unique_ids, counts = np.unique(ids, return_counts=True)
+        for arbitration_id, count in zip(unique_ids.tolist(), counts.tolist()):
+            self.id_counts[arbitration_id] = (
+                self.id_counts.get(arbitration_id, 0) + count
+            )
+
+    def save(self, path: str) -> None:
+        data = {
+            "version": VERSION,
+            "format": self.log_format,
+            "channel": self.channel,
+            "bucket_seconds": self.bucket_seconds,
+            "time_origin": self.time_origin,
+            "buckets": [[b, o, c, sorted(ids)] for b, o, c, ids in self.buckets],
+            "id_counts": {str(k): v for k, v in sorted(self.id_counts.items())},
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LogIndex":
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"unsupported log index version {data.get('version')}")
+        index = cls(data["format"], data["channel"], data["bucket_seconds"])
+        index.time_origin = data["time_origin"]
+        index.buckets = [[b, o, c, set(ids)] for b, o, c, ids in data["buckets"]]
+        index.id_counts = {int(k): v for k, v in data["id_counts"].items()}
+        return index
+
+    def ranges(
+        self,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        ids: Optional[Iterable[int]] = None,
+        file_size: Optional[int] = None,
+    ) -> List[Tuple[int, Optional[int]]]:
+        """Byte ranges (start, end) of the buckets that may hold matching
+        frames. start/end are absolute timestamps, end None means to EOF."""
+        ids = set(ids) if ids else None
+        # a bucket ends where the bucket after it in the file begins
+        offsets = [b[1] for b in self.buckets] + [file_size]
+        result = []
+        for i, (bucket, offset, _, bucket_ids) in enumerate(self.buckets):
+            bucket_start = bucket * self.bucket_seconds
+            if start is not None and bucket_start + self.bucket_seconds <= start:
+                continue
+            if end is not None and bucket_start > end:
+                continue
+            if ids is not None and not ids & bucket_ids:
+                continue
+            if result and result[-1][1] == offset:
+                result[-1] = (result[-1][0], offsets[i + 1])
+            else:
+                result.append((offset, offsets[i + 1]))
+        return result
+
+
+def index_path(log_path: str) -> str:
+    return log_path + EXTENSION
+
+
+def log_format_of(log_path: str) -> str:
+    for log_format, extension in frame_log.EXTENSIONS.items():
+        if log_path.endswith(extension):
+            return log_format
+    raise ValueError(f"unknown log format for {log_path}")
+
+
+def parse_asc_line(line: str, time_origin: float) -> Optional[frame_batch.Frame]:
+    """Parse a classic can frame line as written by python-can's ASCWriter."""
+    tokens = line.split()
+    if len(tokens) < 6 or not tokens[1].isdigit() or tokens[3] not in ("Rx", "Tx"):
+        return None
+    try:
+        timestamp = float(tokens[0]) + time_origin
+        flags = 0
+        frame_id = tokens[2]
+        if frame_id.endswith("x"):
+            flags |= frame_batch.FLAG_EXTENDED_ID
+            frame_id = frame_id[:-1]
+        if tokens[4] == "r":
+            flags |= frame_batch.FLAG_REMOTE_FRAME
+            dlc = int(tokens[5], 16)
+            data = b""
+        else:
+            dlc = int(tokens[5], 16)
+            data = bytes.fromhex("".join(tokens[6 : 6 + dlc]))
+        return (timestamp, int(frame_id, 16), flags, dlc, data.ljust(8, b"\0"))
+    except ValueError:
+        return None
+
+
+def _read_range(file, start: int, end: Optional[int]) -> bytes:
+    file.seek(start)
+    return file.read() if end is None else file.read(end - start)
+
+
+def query(
+    log_path: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    ids: Optional[Iterable[int]] = None,
+    index: Optional[LogIndex] = None,
+) -> Iterator[frame_batch.Frame]:
+    """Yield frames of a log with start <= timestamp <= end (absolute) and an
+    arbitration id in ids, using the sidecar index to skip everything else."""
+    if index is None:
+        index = LogIndex.load(index_path(log_path))
+    ids = set(ids) if ids else None
+    with open(log_path, "rb") as file:
+        for range_start, range_end in index.ranges(start, end, ids):
+            chunk = _read_range(file, range_start, range_end)
+            if index.log_format == "bin":
+                chunk = chunk[: len(chunk) - len(chunk) % frame_batch.RECORD.size]
+                frames = frame_batch.RECORD.iter_unpack(chunk)
+            else:
+                frames = (
+                    parse_asc_line(line, index.time_origin)
+                    for line in chunk.decode(errors="replace").splitlines()
+                )
+            for frame in frames:
+                if frame is None:
+                    continue
+                if start is not None and frame[0] < start:
+                    continue
+                if end is not None and frame[0] > end:
+                    continue
+                if ids is not None and frame[1] not in ids:
+                    continue
+                yield frame
+
+
+def rebuild(log_path: str) -> LogIndex:
+    """Create the index of an existing log by scanning it once."""
+    log_format = log_format_of(log_path)
+    if log_format == "bin":
+        channel, _ = frame_log.read_binary_log(log_path)
+        index = LogIndex(log_format, channel)
+        with open(log_path, "rb") as file:
+            file.seek(frame_log.FILE_HEADER.size)
+            offset = frame_log.FILE_HEADER.size
+            while True:
+                chunk = file.read(frame_batch.RECORD.size * 65536)
+                usable = len(chunk) - len(chunk) % frame_batch.RECORD.size
+                frames = np.frombuffer(chunk[:usable], dtype=frame_batch.FRAME_DTYPE)
+                index.add_records(frames, offset)
+                offset += usable
+                if usable < len(chunk) or not chunk:
+                    break
+    else:
+        index = LogIndex(log_format, 0)
+        with open(log_path, "rb") as file:
+            offset = 0
+            for raw_line in file:
+                line = raw_line.decode(errors="replace")
+                if line.startswith("Begin Triggerblock"):
+                    # relative timestamps start at the first frame, which
+                    # python-can also uses for this header line
+                    index.time_origin = _asc_header_time(line)
+                frame = parse_asc_line(line, index.time_origin)
+                if frame is not None:
+                    index.add_frame(frame[0], frame[1], lambda: offset)
+                offset += len(raw_line)
+    index.save(index_path(log_path))
+    return index
+
+
+def _asc_header_time(line: str) -> float:
+    text = line[len("Begin Triggerblock") :].strip()
+    for fmt in ("%a %b %d %H:%M:%S.%f %Y", "%a %b %d %I:%M:%S.%f %p %Y"):
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            continue
+    return 0.0
+
+
+def _write_output(frames: Iterator[frame_batch.Frame], output: str, channel: int):
+    writer = frame_log.WRITERS[log_format_of(output)](output, channel)
+    count = 0
+    batch = []
+    try:
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) >= 1000:
+                writer.write_batches([frame_batch.pack_frames(batch, channel)])
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batches([frame_batch.pack_frames(batch, channel)])
+            count += len(batch)
+    finally:
+        writer.stop()
+    return count
+
+
+def main():
+    parser = ArgumentParser(description="Query a raw can log through its index")
+    parser.add_argument("log", help="Log file (.asc or .canlog)")
+    parser.add_argument("--start", type=float, help="Seconds from start of log")
+    parser.add_argument("--end", type=float, help="Seconds from start of log")
+    parser.add_argument(
+        "--ids", help="Comma separated hex arbitration ids, e.g. 118,257"
+    )
+    parser.add_argument("--output", "-o", help="Write matching frames to this log")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Rebuild the index by scanning the log"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild or not os.path.exists(index_path(args.log)):
+        index = rebuild(args.log)
+    else:
+        index = LogIndex.load(index_path(args.log))
+
+    log_start = index.start or 0.0
+    ids = [int(x, 16) for x in args.ids.split(",")] if args.ids else None
+    start = log_start + args.start if args.start is not None else None
+    end = log_start + args.end if args.end is not None else None
+
+    if args.output:
+        frames = query(args.log, start, end, ids, index)
+        count = _write_output(frames, args.output, index.channel)
+        print(f"wrote {count} frames to {args.output}")
+    elif start is None and end is None and ids is None:
+        duration = len(index.buckets) * index.bucket_seconds
+        print(f"{args.log}: ~{duration:.0f}s, {sum(index.id_counts.values())} frames")
+        for arbitration_id, count in sorted(index.id_counts.items()):
+            print(f"{arbitration_id:03X}: {count}")
+    else:
+        for timestamp, arbitration_id, _, dlc, data in query(
+            args.log, start, end, ids, index
+        ):
+            print(f"{timestamp:.6f} {arbitration_id:03X} {data[:dlc].hex(' ')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,14 @@ from time import sleep, time
 from typing import List
 
 import psutil
+import redis
 import socketio
 
 import config as cfg
+import subscriptions
 import tools
 from logging_setup import setup_logging
+from message_queue import Emitter
 
 setup_logging()
 logger = logging.getLogger("canserver.main")
@@ -21,15 +24,34 @@ server_stderr = open("/tmp/canserver-logs/server.stderr.log", "w")
 
 
 class CanServer:
-    def __init__(self, address, panda_bind, batch_size, test, timesync) -> None:
+    def __init__(
+        self,
+        address,
+        panda_bind,
+        batch_size,
+        batch_age,
+        publish_rate,
+        test,
+        test_speed,
+        test_source,
+        test_duration,
+        timesync,
+    ) -> None:
         self.server_address = address
         self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.publish_rate = publish_rate
         self.test = test
+        self.test_speed = test_speed
         self.timesync = timesync
         self.last_detected_offset = 0.0
         self.server_proc = None
+        # when the test replay clock starts, set by run()
+        self.test_start = None
         self.client_procs: List[subprocess.Popen] = []
+        self.rx_procs: List[subprocess.Popen] = []
         self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, "canserver.main")
         self._callbacks()
 
         self.server_cmd = shlex.split(
@@ -37,9 +59,21 @@ class CanServer:
         )
         self.rx_client_cmd = shlex.split(
             f"python can_rx_client.py -s http://{self.server_address} --batch_size {self.batch_size}"
+            f" --batch_age {self.batch_age} --publish_rate {self.publish_rate}"
         )
         if test:
-            self.rx_client_cmd += ["--test"]
+            channels = "can0,can1" if cfg.pican_duo else "can0"
+            self.rx_client_cmd += [
+                "--test",
+                "--test_speed",
+                str(test_speed),
+                "--test_channels",
+                channels,
+                "--test_source",
+                test_source,
+            ]
+            if test_duration:
+                self.rx_client_cmd += ["--test_duration", str(test_duration)]
         self.logger_client_cmd = shlex.split(
             f"python can_logger_client.py -s http://{self.server_address}"
         )
@@ -51,12 +85,16 @@ class CanServer:
         )
 
         self.stats = {"last_logged": int(time())}
+        self.fps_totals = {}
         psutil.cpu_percent()  # initial call to set start of interval
         self.rolling_disk_io = [(time(), psutil.disk_io_counters(nowrap=True))]
         self.disk_io_time_window = 30
         self.killer = tools.GracefulKiller()
 
     def run(self):
+        # subscriptions left over from a previous run have no clients, the
+        # browsers resubscribe once they reconnect to the new server
+        subscriptions.clear(redis.StrictRedis("localhost", 6379))
         self.server_proc = subprocess.Popen(
             self.server_cmd,
             stderr=server_stderr,
@@ -67,19 +105,22 @@ class CanServer:
             headers={"X-Username": "canserver.main"},
             wait_timeout=60,
         )
-        self.client_procs.append(subprocess.Popen(self.rx_client_cmd))
+        rx_client_cmd = self.rx_client_cmd
+        if self.test:
+            # give every process time to start before the replay clock runs
+            self.test_start = time() + 5
+            rx_client_cmd = rx_client_cmd + ["--test_start", str(self.test_start)]
+        self.rx_procs.append(subprocess.Popen(rx_client_cmd))
         self.client_procs.append(subprocess.Popen(self.logger_client_cmd))
         if cfg.pican_duo:
-            self.client_procs.append(
-                subprocess.Popen(self.rx_client_cmd + ["-c", "can1"])
-            )
+            self.rx_procs.append(subprocess.Popen(rx_client_cmd + ["-c", "can1"]))
             self.client_procs.append(
                 subprocess.Popen(self.logger_client_cmd + ["-c", "can1"])
             )
+        self.client_procs += self.rx_procs
         self.client_procs.append(subprocess.Popen(self.decoder_client_cmd))
         self.client_procs.append(subprocess.Popen(self.panda_server_cmd))
-        if self.sio.connected:
-            self.sio.emit("broadcast_message", "canserver started")
+        self.emitter.send("canserver started")
         while not self.killer.kill_now:
             self._system_stats()
             self._check_clients()
@@ -90,8 +131,7 @@ class CanServer:
         if reason:
             message += f" for: {reason}"
         logger.info(message)
-        if self.sio.connected:
-            self.sio.emit("broadcast_message", message)
+        self.emitter.send(message)
         for proc in self.client_procs:
             if send_sigint:
                 proc.send_signal(signal.SIGINT)
@@ -156,13 +196,24 @@ class CanServer:
         except ZeroDivisionError:
             pass
 
-        if self.sio.connected:
-            self.sio.emit("broadcast_stats", {"system": system_stats})
+        self.emitter.emit("stats", {"system": system_stats})
 
     def _check_clients(self):
         dead_procs = [x for x in self.client_procs if x.poll() != None]
         if dead_procs:
-            self.shutdown(reason="Dead client")
+            if self.test and all(
+                x in self.rx_procs and x.returncode == 0 for x in dead_procs
+            ):
+                # let every channel finish its replay
+                if len(dead_procs) == len(self.rx_procs):
+                    self._log_test_throughput()
+                    self.shutdown(reason="test data complete")
+            else:
+                self.shutdown(reason="Dead client")
+
+    def _log_test_throughput(self):
+        for stage, (total, samples, peak) in sorted(self.fps_totals.items()):
+            logger.info(f"{stage}: {total / samples:.0f} fps average, {peak} fps peak")
 
     def _cpu_temp(self):
         try:
@@ -179,6 +230,11 @@ class CanServer:
             return
 
     def _callbacks(self):
+        @self.sio.event
+        def connect():
+            signal = f"{cfg.vehicle_time_frame_id}.{cfg.vehicle_time_signal_name}"
+            self.sio.emit("subscribe", {"signals": [signal]})
+
         @self.sio.event
         def message(msg):
             logger.info(msg)
@@ -186,6 +242,16 @@ class CanServer:
         @self.sio.event
         def stats(data):
             tools.deep_update(self.stats, data)
+            if self.test:
+                for stage, fps in data.get("fps", {}).items():
+                    total, samples, peak = self.fps_totals.get(stage, (0, 0, 0))
+                    # only count seconds where the stage was moving frames
+                    if fps:
+                        self.fps_totals[stage] = (
+                            total + fps,
+                            samples + 1,
+                            max(peak, fps),
+                        )
             now = int(time())
             if self.stats["last_logged"] + 60 <= now:
                 logger.debug(self.stats)
@@ -213,7 +279,7 @@ class CanServer:
                         self.last_detected_offset = 0.0
                         logger.debug(f"Adjusted system time by {offset} seconds")
                         if abs(offset) > 1.0:
-                            self.sio.emit("broadcast_time_reset")
+                            self.emitter.emit("time_reset")
 
         @self.sio.event
         def time_reset():
@@ -221,6 +287,7 @@ class CanServer:
             self.count_start = now
             self.frame_count = 0
             self.stats = {"last_logged": int(time())}
+            self.fps_totals = {}
             psutil.cpu_percent()  # initial call to set start of interval
             self.rolling_disk_io = [(time(), psutil.disk_io_counters(nowrap=True))]
 
@@ -240,11 +307,39 @@ def parse_args():
         help="Address to bind panda server to",
     )
     parser.add_argument(
-        "--batch_size", default=50, help="Size of batches to send can frames"
+        "--batch_size", default=1000, help="Maximum size of batches to send can frames"
+    )
+    parser.add_argument(
+        "--batch_age",
+        default=0.02,
+        help="Maximum seconds a frame may wait in a batch before publishing",
+    )
+    parser.add_argument(
+        "--publish_rate",
+        default=100,
+        help="Target batches per second per channel, batch size adapts to bus rate",
     )
     parser.add_argument(
         "--test", action="store_true", help="Run in test mode (no can device)"
     )
+    parser.add_argument(
+        "--test_speed",
+        default=1.0,
+        type=float,
+        help="Test data replay speed multiplier, 0 replays as fast as possible",
+    )
+    parser.add_argument(
+        "--test_source",
+        default="asc",
+        choices=["asc", "synthetic"],
+        help="Test frames from test_data/*.asc or generated from the dbc",
+    )
+    parser.add_argument(
+        "--test_duration",
+        default=None,
+        type=float,
+        help="Seconds of synthetic test traffic (default: endless)",
+    )
     parser.add_argument(
         "--timesync", action="store_true", help="Sync system time from vehicle"
     )
@@ -256,7 +351,16 @@ def main():
     logger.info("################ CAN-Server is starting ################")
     args = parse_args()
     canserver = CanServer(
-        args.address, args.panda_bind, args.batch_size, args.test, args.timesync
+        args.address,
+        args.panda_bind,
+        args.batch_size,
+        args.batch_age,
+        args.publish_rate,
+        args.test,
+        args.test_speed,
+        args.test_source,
+        args.test_duration,
+        args.timesync,
     )
     try:
         canserver.run()
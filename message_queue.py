@@ -0,0 +1,58 @@
+"""Emit socket.io events to every client without a hop through server.py.
+
+server.py shares its clients through a redis message queue
+(cfg.sio_message_queue), so any process can publish an event on redis and
+the server(s) hand it straight to the connected clients, to a room or to
+everyone. Without a message queue configured, events fall back to the
+broadcast_* relay handlers in server.py.
+
+Stats are also stored for the snapshot new clients get, see snapshot.py.
+"""
+
+from time import time
+
+import redis
+import socketio
+
+import config as cfg
+import snapshot
+
+_RELAYS = {
+    "stats": "broadcast_stats",
+    "vehicle_stats": "broadcast_vehicle_stats",
+    "logging_control": "broadcast_logging_control",
+    "time_reset": "broadcast_time_reset",
+}
+
+
+class Emitter:
+    def __init__(self, sio: socketio.Client, name: str) -> None:
+        self.sio = sio
+        self.name = name
+        self._red = redis.StrictRedis("localhost", 6379)
+        self._manager = None
+        if cfg.sio_message_queue:
+            self._manager = socketio.RedisManager(
+                cfg.sio_message_queue, write_only=True
+            )
+
+    def emit(self, event: str, data=(), to: str = None) -> None:
+        """Emit to all clients, or to a room. Empty data sends no arguments."""
+        if event == "stats":
+            snapshot.save_stats(self._red, self.name, data, time())
+        if self._manager is not None:
+            self._manager.emit(event, data, to=to)
+        elif self.sio.connected:
+            if to is not None:
+                raise ValueError("emitting to a room needs cfg.sio_message_queue")
+            if data == ():
+                self.sio.emit(_RELAYS[event])
+            else:
+                self.sio.emit(_RELAYS[event], data)
+
+    def send(self, message: str) -> None:
+        """A chat message to all clients, like broadcast_message."""
+        if self._manager is not None:
+            self._manager.emit("message", f"{self.name}: {message}")
+        elif self.sio.connected:
+            self.sio.emit("broadcast_message", message)
@@ -1,30 +1,74 @@
+import itertools
 import logging
 import socket
 import struct
+from collections import deque
 from time import time
-from typing import Tuple
-
-from can import Message
-from can.util import channel2int
+from typing import FrozenSet, List, Optional, Set, Tuple
 
+import frame_batch
 from logging_setup import setup_logging
 
 setup_logging()
 
+# panda can packet: address << 21, dlc | bus << 4, data padded to 8 bytes
+RECORD = struct.Struct("<II8s")
+# records per datagram, so a datagram fits a 1500 byte mtu (ip + udp headers: 28)
+MAX_RECORDS = (1500 - 28) // RECORD.size
+
+# rate limited clients may send this many seconds worth of frames at once
+_BURST_SECONDS = 0.1
+# and queue at most this many, so they get recent frames instead of old ones
+_QUEUE_SECONDS = 1.0
+
+# (bus, frame id, timestamp, packed record)
+PackedFrame = Tuple[int, int, float, bytes]
+# (payload, frame count, timestamp of the oldest frame)
+Datagram = Tuple[bytes, int, float]
+
+
+def pack_frame(bus: int, frame: frame_batch.Frame) -> PackedFrame:
+    timestamp, frame_id, _, dlc, data = frame
+    record = RECORD.pack(frame_id << 21, (dlc & 0x0F) | (bus << 4), data)
+    return bus, frame_id, timestamp, record
+
+
+def datagrams(frames: List[PackedFrame]) -> List[Datagram]:
+    """Join packed frames into as few datagrams as the mtu allows."""
+    result = []
+    for i in range(0, len(frames), MAX_RECORDS):
+        chunk = frames[i : i + MAX_RECORDS]
+        result.append(
+            (
+                b"".join(frame[3] for frame in chunk),
+                len(chunk),
+                min(frame[2] for frame in chunk),
+            )
+        )
+    return result
+
 
 # Not actually a client, just represents a client for panda_server.py
 class PandaClient:
     _ack_packet = struct.pack("<IIQ", 0x006 << 21, 15 << 4, 0)
+    _filter_versions = itertools.count()
     _udp_socket: socket.socket
     address: Tuple[str, int]
     connected: bool
     last_seen: float
     is_v2: bool
     v2_send_all: bool
-    v2_filter_list: Tuple[list]
+    v2_filters: Tuple[Set[int], Set[int]]
+    # changes whenever the frames this client wants change, unique across clients
+    filter_version: int
 
     def __init__(
-        self, socket: socket.socket, data: bytes, address: Tuple[str, int]
+        self,
+        socket: socket.socket,
+        data: bytes,
+        address: Tuple[str, int],
+        max_fps: float = 0,
+        queue_size: int = 64,
     ) -> None:
         self.logger = logging.getLogger(f"panda_client.{address[0]}")
         self._udp_socket = socket
@@ -32,7 +76,23 @@ class PandaClient:
         self.connected = False
         self.is_v2 = False
         self.v2_send_all = False
-        self.v2_filter_list = ([], [])
+        self.v2_filters = (set(), set())
+        self._filters_changed()
+
+        self.max_fps = max_fps
+        self.queue_size = queue_size
+        self.queued_frames = 0
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.send_errors = 0
+        self._queue = deque()
+        # a full datagram must always fit the bucket and the queue
+        self._burst = max(max_fps * _BURST_SECONDS, MAX_RECORDS)
+        self._max_queued_frames = (
+            max(max_fps * _QUEUE_SECONDS, MAX_RECORDS) if max_fps else float("inf")
+        )
+        self._tokens = self._burst
+        self._last_refill = time()
         self.process(data, address)
 
     def process(self, data: bytes, address: Tuple[str, int]):
@@ -67,21 +127,73 @@ class PandaClient:
             self.logger.info("Hearbeat expired")
             self._disconnect()
 
-    def send_frame(self, frame: Message) -> bool:
+    def wanted_frames(self) -> Optional[FrozenSet[Tuple[int, int]]]:
+        """The (bus, frame id) pairs this client wants, None for all frames."""
         if not self.connected:
-            return False
-        frame_id = frame.arbitration_id
-        bus = channel2int(frame.channel)
-        if (not self.is_v2) or self.v2_send_all or frame_id in self.v2_filter_list[bus]:
-            data = struct.pack(
-                "<II",
-                frame.arbitration_id << 21,
-                (frame.dlc & 0x0F) | (channel2int(frame.channel) << 4),
-            )
-            data += struct.pack("<%dB" % frame.dlc, *frame.data)
-            self._send_raw(data)
-            return True
-        return False
+            return frozenset()
+        if not self.is_v2 or self.v2_send_all:
+            return None
+        return frozenset(
+            (bus, frame_id)
+            for bus, frame_ids in enumerate(self.v2_filters)
+            for frame_id in frame_ids
+        )
+
+    def enqueue(self, datagrams: List[Datagram]) -> None:
+        """Queue datagrams for flush(), dropping the oldest when full.
+        Rate limited clients queue at most _QUEUE_SECONDS of frames."""
+        if not self.connected:
+            return
+        queue = self._queue
+        for datagram in datagrams:
+            while queue and (
+                len(queue) >= self.queue_size
+                or self.queued_frames + datagram[1] > self._max_queued_frames
+            ):
+                dropped = queue.popleft()[1]
+                self.queued_frames -= dropped
+                self.dropped_frames += dropped
+            queue.append(datagram)
+            self.queued_frames += datagram[1]
+
+    def flush(self, now: float, sent_timestamps: Optional[list] = None) -> int:
+        """Send queued datagrams within the rate limit and until the socket
+        would block. Returns the number of frames sent, and adds the oldest
+        frame timestamp of every datagram sent to sent_timestamps."""
+        queue = self._queue
+        if self.max_fps:
+            elapsed = now - self._last_refill
+            self._tokens = min(self._tokens + elapsed * self.max_fps, self._burst)
+            self._last_refill = now
+        sent = 0
+        while queue:
+            payload, count, oldest = queue[0]
+            if self.max_fps and self._tokens < count:
+                break
+            try:
+                self._udp_socket.sendto(payload, self.address)
+            except BlockingIOError:
+                # socket buffer full, keep the rest for the next flush
+                break
+            except OSError as e:
+                if not self.send_errors:
+                    self.logger.warning(f"Send failed: {e}")
+                self.send_errors += 1
+                queue.popleft()
+                self.queued_frames -= count
+                continue
+            queue.popleft()
+            self.queued_frames -= count
+            if self.max_fps:
+                self._tokens -= count
+            sent += count
+            if sent_timestamps is not None:
+                sent_timestamps.append(oldest)
+        self.sent_frames += sent
+        return sent
+
+    def _filters_changed(self):
+        self.filter_version = next(self._filter_versions)
 
     def _send_raw(self, data: bytes):
         if data == self._ack_packet:
@@ -91,6 +203,7 @@ class PandaClient:
     def _connect_v1(self):
         self.logger.info(f"New v1 connection from {self.address[0]}:{self.address[1]}")
         self.connected = True
+        self._filters_changed()
         # send a v2 ack just in case the client can upgrade
         self._send_raw(self._ack_packet)
 
@@ -98,6 +211,7 @@ class PandaClient:
         self.logger.info(f"New v2 connection from {self.address[0]}:{self.address[1]}")
         self.connected = True
         self.is_v2 = True
+        self._filters_changed()
         self._send_raw(self._ack_packet)
 
     def _disconnect(self):
@@ -105,27 +219,29 @@ class PandaClient:
         self.connected = False
         self.is_v2 = False
         self.v2_send_all = False
-        self.v2_filter_list = ([], [])
+        self.v2_filters = (set(), set())
+        self._filters_changed()
+        self._queue.clear()
+        self.queued_frames = 0
 
     def _filter_add(self, data: bytes):
         for byte_chunk in self._divide_bytes(data[1:], 3):
             buses, frame_id = self._get_filter_info_from(byte_chunk)
             for bus in buses:
-                self.v2_filter_list[bus].append(frame_id)
+                self.v2_filters[bus].add(frame_id)
+        self._filters_changed()
         self.logger.debug(
-            f"Filter add command received. Filter is now: {self.v2_filter_list}"
+            f"Filter add command received. Filter is now: {self.v2_filters}"
         )
 
     def _filter_del(self, data: bytes):
         for byte_chunk in self._divide_bytes(data[1:], 3):
             buses, frame_id = self._get_filter_info_from(byte_chunk)
             for bus in buses:
-                try:
-                    self.v2_filter_list[bus].remove(frame_id)
-                except ValueError:
-                    pass
+                self.v2_filters[bus].discard(frame_id)
+        self._filters_changed()
         self.logger.debug(
-            f"Filter del command received. Filter is now: {self.v2_filter_list}"
+            f"Filter del command received. Filter is now: {self.v2_filters}"
         )
 
     def _divide_bytes(self, bts: bytes, chunk_size: int):
@@ -144,9 +260,11 @@ class PandaClient:
 
     def _filter_all(self):
         self.v2_send_all = True
+        self._filters_changed()
         self.logger.debug("Filter (include) all command received")
 
     def _filter_clear(self):
         self.v2_send_all = False
-        self.v2_filter_list = ([], [])
+        self.v2_filters = (set(), set())
+        self._filters_changed()
         self.logger.debug("Filter clear command received")
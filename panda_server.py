@@ -1,37 +1,88 @@
 import logging
-import pickle
+import selectors
 import socket
 from argparse import ArgumentParser
-from time import sleep, time
-from typing import Dict, List
+from time import time
+from typing import Dict, Iterable, List, Tuple
 
+import numpy as np
 import redis
 import socketio
-from can import Message
 
+import config as cfg
+import frame_batch
+from frame_table import LatestFrameTable
+from latency import LatencyStats, frame_ages
 from logging_setup import setup_logging
-from panda_client import PandaClient
+from message_queue import Emitter
+from panda_client import PackedFrame, PandaClient, datagrams, pack_frame
 
 setup_logging()
 
 
+class FanoutIndex:
+    """Panda clients grouped by identical filters, and the groups wanting
+    each (bus, frame id). Rebuilt only when a client or its filter changes."""
+
+    def __init__(self) -> None:
+        self._signature = None
+        # clients that want every frame
+        self.send_all: List[PandaClient] = []
+        self.groups: List[List[PandaClient]] = []
+        # (bus, frame id) -> indexes into groups
+        self.index: Dict[Tuple[int, int], List[int]] = {}
+
+    def update(self, clients: Iterable[PandaClient]) -> None:
+        clients = list(clients)
+        signature = tuple(client.filter_version for client in clients)
+        if signature == self._signature:
+            return
+        self._signature = signature
+        self.send_all = []
+        groups: Dict[frozenset, List[PandaClient]] = {}
+        for client in clients:
+            wanted = client.wanted_frames()
+            if wanted is None:
+                self.send_all.append(client)
+            elif wanted:
+                groups.setdefault(wanted, []).append(client)
+        self.groups = list(groups.values())
+        self.index = {}
+        for i, wanted in enumerate(groups):
+            for key in wanted:
+                self.index.setdefault(key, []).append(i)
+
+
 class PandaServer:
     def __init__(self):
         self._parse_args()
         self.logger = logging.getLogger("panda_server")
         self.sio = socketio.Client()
+        self.emitter = Emitter(self.sio, "panda_server")
         self.red = redis.StrictRedis("localhost", 6379)
         self.red_sub = self.red.pubsub()
         self.last_stats_time = time()
         self.frame_count = 0
-        self._last_decoded_ts = {"id": "ts"}
-        self._frame_batch = []
-        self._batch_start = time()
-        self._batch_interval = 1 / 120  # stream 120hz to panda clients
+        self._latest_frames = LatestFrameTable()
+        self._latency = LatencyStats()
+        self._fanout_interval = 1 / 120  # stream 120hz to panda clients
+        self._housekeeping_interval = 1
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.setblocking(False)
         self.udp_socket.bind(self.panda_address)
+        self._selector = selectors.DefaultSelector()
+        # only touched by the thread running the event loop
         self.panda_clients: Dict[str, PandaClient] = {}
+        # hosts whose stats are still shown in the web UI
+        self._removed_hosts: List[str] = []
+        self._fanout_index = FanoutIndex()
+        self._id_periods = {
+            int(frame_id, 16): 1 / rate
+            for frame_id, rate in cfg.panda_id_max_rate.items()
+            if rate
+        }
+        # (bus, frame id) -> earliest time it may be sent again
+        self._id_next_due: Dict[Tuple[int, int], float] = {}
         self._callbacks()
 
     def _parse_args(self):
@@ -48,9 +99,15 @@ class PandaServer:
             default="127.0.0.1:1338",
             help="Address to bind panda server to",
         )
+        parser.add_argument(
+            "--frame_latency",
+            action="store_true",
+            help="Measure frame latency without cfg.trace_latency (benchmark.py)",
+        )
 
         args = parser.parse_args()
         self.server_address = args.server
+        self._frame_latency = cfg.trace_latency or args.frame_latency
         p_host = args.panda_bind.split(":")[0]
         p_port = int(args.panda_bind.split(":")[1])
         self.panda_address = (p_host, p_port)
@@ -66,26 +123,8 @@ class PandaServer:
             self._pubsub_thread = self.red_sub.run_in_thread(
                 sleep_time=0.1, daemon=True
             )
-            while True:
-                sleep(0.05)
-                now = time()
-                if now >= self.last_stats_time + 1:
-                    for client in self.panda_clients.values():
-                        client.alive_check()
-                    self._cleanup_clients()
-                    self._stats_publisher()
-                    self.last_stats_time = now
-
-                try:
-                    data, address = self.udp_socket.recvfrom(1024)
-                except socket.error:
-                    continue
-                try:
-                    self.panda_clients[address[0]].process(data, address)
-                except KeyError:
-                    self.panda_clients[address[0]] = PandaClient(
-                        self.udp_socket, data, address
-                    )
+            self._selector.register(self.udp_socket, selectors.EVENT_READ)
+            self._event_loop()
         except KeyboardInterrupt:
             pass
         except Exception as e:
@@ -95,71 +134,166 @@ class PandaServer:
 
     def shutdown(self):
         self._pubsub_thread.stop()
+        self._selector.close()
+
+    def _event_loop(self):
+        # control datagrams are handled as soon as they arrive, fanout and
+        # housekeeping run on timers in between
+        next_fanout = time()
+        next_housekeeping = next_fanout + self._housekeeping_interval
+        while True:
+            timeout = max(min(next_fanout, next_housekeeping) - time(), 0)
+            if self._selector.select(timeout):
+                self._receive_datagrams()
+            now = time()
+            if now >= next_fanout:
+                self._fanout()
+                # skip ticks missed while busy rather than bursting them
+                next_fanout = max(next_fanout + self._fanout_interval, now)
+            if now >= next_housekeeping:
+                for client in self.panda_clients.values():
+                    client.alive_check()
+                self._cleanup_clients()
+                self._stats_publisher()
+                next_housekeeping = now + self._housekeeping_interval
+
+    def _receive_datagrams(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. icmp port unreachable from an earlier send to a client
+                continue
+            try:
+                self.panda_clients[address[0]].process(data, address)
+            except KeyError:
+                max_fps = cfg.panda_client_max_fps
+                self.panda_clients[address[0]] = PandaClient(
+                    self.udp_socket,
+                    data,
+                    address,
+                    max_fps=max_fps.get(address[0], max_fps.get("default", 0)),
+                    queue_size=cfg.panda_client_queue_size,
+                )
 
     def _pubsub_handler(self, msg):
         if msg and isinstance(msg, dict) and msg["type"] == "pmessage":
-            pickled_batch = msg.get("data")
-            batch = pickle.loads(pickled_batch)
-            self._on_frame_batch(batch)
+            packed_batch = msg.get("data")
+            now = time()
+            if self._frame_latency:
+                self._latency.add("panda latency", frame_ages(packed_batch, now))
+            if cfg.trace_latency:
+                publish_time = frame_batch.publish_time(packed_batch)
+                if publish_time is not None:
+                    self._latency.add("panda redis latency", now - publish_time)
+            channel, frames = frame_batch.unpack(packed_batch)
+            self._latest_frames.update(frames, channel)
 
-    def _on_frame_batch(self, batch):
-        self._frame_batch.extend(batch)
+    def _fanout(self):
         now = time()
-        if now >= self._batch_start + self._batch_interval:
-            msgs_to_send = self._clean_batch(self._frame_batch)
-            try:
-                clients = list(self.panda_clients.values()).copy()
-                for client in clients:
-                    for frame in msgs_to_send:
-                        try:
-                            sent = client.send_frame(frame)
-                        except:
-                            sent = False
-                        if sent:
-                            self.frame_count += 1
-            except Exception as e:
-                self.logger.exception(e)
-                self.shutdown()
-            self._frame_batch = []
-            self._batch_start = now
-
-    def _clean_batch(self, batch: List[Message]):
-        batch.reverse()
-        cleaned_batch = {}
-        for msg in batch:
-            try:
-                if self._last_decoded_ts[msg.arbitration_id] >= msg.timestamp:
-                    continue
-            except:
-                pass
-            cleaned_batch[msg.arbitration_id] = msg
-            self._last_decoded_ts[msg.arbitration_id] = msg.timestamp
-        batch = list(cleaned_batch.values())
-        batch.reverse()
-        return batch
+        drained = self._latest_frames.drain()
+        if drained and self._id_periods:
+            drained = self._limit_id_rates(drained, now)
+        if drained and self.panda_clients:
+            self._route(drained)
+        sent_timestamps = [] if cfg.trace_latency else None
+        for client in self.panda_clients.values():
+            self.frame_count += client.flush(now, sent_timestamps)
+        if sent_timestamps:
+            self._latency.add("panda send latency", time() - np.array(sent_timestamps))
+
+    def _limit_id_rates(self, drained, now):
+        periods = self._id_periods
+        next_due = self._id_next_due
+        allowed = []
+        held = []
+        for key, frame in drained:
+            period = periods.get(key[1])
+            if period is None:
+                allowed.append((key, frame))
+                continue
+            due = next_due.get(key, 0.0)
+            if now < due:
+                held.append(key)
+                continue
+            # tolerate a late tick without sending twice in a row
+            next_due[key] = max(due, now - period) + period
+            allowed.append((key, frame))
+        # the newest frame of a held id goes out once it is due
+        self._latest_frames.mark_dirty(held)
+        return allowed
+
+    def _route(self, drained):
+        # pack every frame once, and every datagram once per group of clients
+        # with the same filters, so the work follows the deliveries
+        packed = [pack_frame(bus, frame) for (bus, _), frame in drained]
+        index = self._fanout_index
+        index.update(self.panda_clients.values())
+        if index.send_all:
+            self._enqueue(index.send_all, packed)
+        if index.groups:
+            group_frames = [[] for _ in index.groups]
+            lookup = index.index
+            for frame in packed:
+                for group in lookup.get((frame[0], frame[1]), ()):
+                    group_frames[group].append(frame)
+            for clients, frames in zip(index.groups, group_frames):
+                if frames:
+                    self._enqueue(clients, frames)
+
+    def _enqueue(self, clients: List[PandaClient], frames: List[PackedFrame]):
+        packets = datagrams(frames)
+        for client in clients:
+            client.enqueue(packets)
 
     def _stats_publisher(self):
         now = time()
         delta = now - self.last_stats_time
         fps = int(self.frame_count / delta)
 
-        if self.sio.connected:
-            self.sio.emit(
-                "broadcast_stats",
-                {
-                    "fps": {"panda": fps},
-                    "system": {"panda clients": {"value": len(self.panda_clients)}},
+        self.emitter.emit(
+            "stats",
+            {
+                "fps": {"panda": fps},
+                "system": {
+                    "panda clients": {"value": len(self.panda_clients)},
+                    **self._client_stats(delta),
+                    **self._latency.stats(),
                 },
-            )
+            },
+        )
+        self._latency.reset()
         self.last_stats_time = now
         self.frame_count = 0
 
+    def _client_stats(self, delta):
+        stats = {}
+        for host, client in self.panda_clients.items():
+            stats[f"panda {host} queued"] = {"value": client.queued_frames}
+            stats[f"panda {host} sent"] = {
+                "value": int(client.sent_frames / delta),
+                "unit": "fps",
+            }
+            stats[f"panda {host} dropped"] = {"value": client.dropped_frames}
+            stats[f"panda {host} send errors"] = {"value": client.send_errors}
+            client.sent_frames = 0
+        # None removes a stat from the web UI
+        for host in self._removed_hosts:
+            if host not in self.panda_clients:
+                for name in ("queued", "sent", "dropped", "send errors"):
+                    stats[f"panda {host} {name}"] = None
+        self._removed_hosts = []
+        return stats
+
     def _cleanup_clients(self):
         dead_panda_client_hosts = [
             x.address[0] for x in self.panda_clients.values() if not x.connected
         ]
         for host in dead_panda_client_hosts:
             del self.panda_clients[host]
+            self._removed_hosts.append(host)
 
     def _callbacks(self):
         @self.sio.event
@@ -171,8 +305,9 @@ class PandaServer:
             now = time()
             self.last_stats_time = now
             self.frame_count = 0
-            self._batch_start = now
-            self._frame_batch = []
+            self._latest_frames.clear()
+            self._latency.reset()
+            self._id_next_due = {}
 
 
 if __name__ == "__main__":
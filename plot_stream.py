@@ -0,0 +1,110 @@
+"""Full-rate signal samples for live charts (public/plot.html).
+
+Clients emit "plot_subscribe" to server.py with the signals to chart and
+the samples per second they want of each:
+
+    {"signals": ["ID175WheelSpeed.WheelSpeedFL", "129.SteeringAngle129"],
+     "rate": 100}
+
+Any message in the dbc can be charted, not only those in cfg.can_filter.
+The rate is capped at cfg.plot_max_rate and the number of signals at
+cfg.plot_max_signals. Like vehicle subscriptions (subscriptions.py) every
+distinct subscription is a room, and CanDecoder decodes the frames of the
+charted messages with a BatchDecoder every cfg.plot_interval seconds and
+emits each room a "plot" event:
+
+    {"series": [{"signals": [signal, ...], "data": bytes}, ...]}
+
+with one series per message. data holds n samples as packed columns: n
+float64 timestamps followed by n float32 values per signal, so the browser
+can wrap it in typed arrays without parsing it.
+"""
+
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import config as cfg
+
+KIND = "plot"
+
+
+def normalize(request) -> (str, dict):
+    """The room and the stored subscription for a "plot_subscribe" request."""
+    if not isinstance(request, dict):
+        raise ValueError("plot subscription must be an object")
+    signals = request.get("signals")
+    if not isinstance(signals, list) or not all(
+        isinstance(s, str) and "." in s for s in signals
+    ):
+        raise ValueError("signals must be a list of '<message>.<signal>'")
+    if not signals or len(signals) > cfg.plot_max_signals:
+        raise ValueError(f"plot 1 to {cfg.plot_max_signals} signals")
+    try:
+        rate = float(request.get("rate", cfg.plot_max_rate))
+    except (TypeError, ValueError):
+        raise ValueError("rate must be a number")
+    rate = min(max(rate, 1.0), cfg.plot_max_rate)
+    subscription = {"signals": sorted(set(signals)), "rate": rate}
+    digest = hashlib.sha1(json.dumps(subscription).encode()).hexdigest()
+    return f"plot:{digest[:8]}", subscription
+
+
+def pack(samples: np.ndarray, names: List[str]) -> bytes:
+    """Timestamps and signal columns of BatchDecoder samples, see above."""
+    columns = [samples["timestamp"].astype("<f8").tobytes()]
+    for name in names:
+        columns.append(samples[name].astype("<f4").tobytes())
+    return b"".join(columns)
+
+
+class PlotRoom:
+    """A plot subscription resolved against the dbc.
+
+    columns maps frame ids to the signal names charted from the message,
+    labels to the selectors they were asked for with. Samples are thinned
+    to one per 1/rate second bucket.
+    """
+
+    def __init__(self, name: str, rate: float, columns: dict, labels: dict):
+        self.name = name
+        self.rate = rate
+        self.columns: Dict[int, List[str]] = columns
+        self.labels: Dict[int, List[str]] = labels
+        self._last_bucket: Dict[int, float] = {}
+
+    @classmethod
+    def resolve(cls, name: str, subscription: dict, db) -> "PlotRoom":
+        columns = {}
+        labels = {}
+        for selector in subscription["signals"]:
+            message, _, signal = selector.partition(".")
+            try:
+                db_msg = db.get_message_by_name(message)
+            except KeyError:
+                try:
+                    db_msg = db.get_message_by_frame_id(int(message, 16))
+                except (KeyError, ValueError):
+                    continue
+            if signal not in [sig.name for sig in db_msg.signals]:
+                continue
+            columns.setdefault(db_msg.frame_id, []).append(signal)
+            labels.setdefault(db_msg.frame_id, []).append(selector)
+        return cls(name, subscription["rate"], columns, labels)
+
+    def series(self, frame_id: int, samples: np.ndarray) -> Optional[dict]:
+        """The samples of one message for this room, or None."""
+        names = self.columns.get(frame_id)
+        if names is None or not len(samples):
+            return None
+        buckets = np.floor(samples["timestamp"] * self.rate)
+        keep = np.empty(len(buckets), dtype=bool)
+        keep[0] = buckets[0] != self._last_bucket.get(frame_id)
+        np.not_equal(buckets[1:], buckets[:-1], out=keep[1:])
+        samples = samples[keep]
+        if not len(samples):
+            return None
+        self._last_bucket[frame_id] = buckets[-1]
+        return {"signals": self.labels[frame_id], "data": pack(samples, names)}
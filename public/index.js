@@ -8,9 +8,15 @@ const sio = io({
     }
 });
 
+let vehicleSchema = null;
+let vehicleSchemaRequested = false;
+
 sio.on('connect', () => {
     console.log('connected');
     document.getElementById("status").innerHTML = 'Connected';
+    vehicleSchema = null;
+    requestVehicleSchema();
+    subscribe(vehicleSubscription());
 });
 
 sio.on('connect_error', (e) => {
@@ -21,10 +27,7 @@ sio.on('connect_error', (e) => {
 sio.on('disconnect', () => {
     console.log('disconnected');
     document.getElementById("status").innerHTML = 'Disconnected';
-    clearTable(document.getElementById('fps_stats'));
-    clearTable(document.getElementById('system_stats'));
-    clearTable(document.getElementById('vehicle_stats'));
-    updateButtons();
+    clearViews();
 });
 
 sio.on('message', (message) => {
@@ -46,112 +49,255 @@ sio.on('vehicle_stats', (data) => {
     updateVehicleStats(data);
 })
 
-function updateFpsStats(fps) {
-    table = document.getElementById('fps_stats');
-    for (let channel in fps) {
-        row = document.getElementById(`fps_${channel}`);
-        if (row == null) {
-            row = document.createElement("tr");
-            row.id = `fps_${channel}`;
-            table.tBodies[0].appendChild(row);
+// compact stream, see vehicle_stream.py
+sio.on('vehicle_delta', (data) => {
+    if (data instanceof ArrayBuffer) {
+        data = msgpackDecode(new Uint8Array(data));
+    }
+    if (!vehicleSchema || vehicleSchema.version !== data.version) {
+        requestVehicleSchema();
+        return;
+    }
+    updateVehicleStats(expandVehicleDelta(data));
+})
+
+// index.html?dashboard=driving or index.html?signals=ID257DIspeed,118.DI_gear,
+// everything by default, see subscriptions.py
+function vehicleSubscription() {
+    const params = new URLSearchParams(window.location.search);
+    if (params.get('dashboard')) {
+        return {dashboard: params.get('dashboard'), format: 'delta', snapshot: true};
+    }
+    const signals = params.get('signals');
+    return {signals: signals ? signals.split(',') : ['*'], format: 'delta', snapshot: true};
+}
+
+function subscribe(subscription) {
+    // updates of the new room can arrive before the ack
+    vehicleView.clear();
+    sio.emit('subscribe', subscription, (result) => {
+        if (result.error) {
+            $("<div />").text(`Subscription failed: ${result.error}`).appendTo("#messages");
+            return;
         }
-        row.innerHTML = `<td>${channel}</td><td>${fps[channel]}</td>`;
+        if (result.snapshot) {
+            // last values right away, without replacing newer live ones
+            updateFpsStats(result.snapshot.stats.fps || {});
+            updateSystemStats(result.snapshot.stats.system || {});
+            updateVehicleStats(result.snapshot.vehicle, true);
+        }
+    });
+}
+
+function requestVehicleSchema() {
+    if (vehicleSchemaRequested) {
+        return;
     }
-    sortTable(table);
+    vehicleSchemaRequested = true;
+    sio.emit('vehicle_schema', (schema) => {
+        vehicleSchemaRequested = false;
+        vehicleSchema = schema;
+    });
 }
 
-function updateSystemStats(stats) {
-    table = document.getElementById('system_stats');
-    for (let item in stats) {
-        row = document.getElementById(`sys_stat_${item}`);
-        if (row == null) {
-            row = document.createElement("tr");
-            row.id = `sys_stat_${item}`;
-            table.tBodies[0].appendChild(row);
+// turn index/value arrays back into the vehicle_stats layout
+function expandVehicleDelta(data) {
+    const stats = {};
+    for (let n = 0; n < data.i.length; n++) {
+        const [msg, sig, unit, choices] = vehicleSchema.signals[data.i[n]];
+        const value = data.v[n];
+        if (!stats[msg]) {
+            stats[msg] = {data: {}, timestamp: data.t};
         }
-        if (stats[item].unit) { 
-            rowHTML = `<td>${item}</td><td>${stats[item].value} ${stats[item].unit}</td>`;
+        const state = choices ? choices[value] : undefined;
+        if (state !== undefined) {
+            stats[msg].data[sig] = {state: state, value: value};
         } else {
-            rowHTML = `<td>${item}</td><td>${stats[item].value}</td>`
+            stats[msg].data[sig] = {value: value, unit: unit};
         }
-        row.innerHTML = rowHTML;
     }
-    sortTable(table);
-    updateButtons();
+    return stats;
 }
 
-function updateVehicleStats(stats) {
-    table = document.getElementById('vehicle_stats');
-    for (let msg in stats) {
-        for (let sig in stats[msg].data) {
-            row = document.getElementById(`veh_stat_${msg}_${sig}`);
-            if (row == null) {
-                row = document.createElement("tr");
-                row.id = `veh_stat_${msg}_${sig}`;
-                table.tBodies[0].appendChild(row);
+// A table body kept in sync with keyed rows. Rows are inserted once at their
+// sorted position and afterwards only cells whose text changed are written.
+// Updates are queued and applied together once per animation frame.
+class TableView {
+    constructor(tableId) {
+        this.tableId = tableId;
+        this.tbody = null;
+        this.rows = new Map();
+        this.sorted = [];
+        this.pending = new Map();
+    }
+
+    // index.js loads before the tables exist
+    get body() {
+        if (!this.tbody) {
+            this.tbody = document.getElementById(this.tableId).tBodies[0];
+        }
+        return this.tbody;
+    }
+
+    set(key, sortKey, texts) {
+        this.pending.set(key, [sortKey, texts]);
+        scheduleRender();
+    }
+
+    delete(key) {
+        this.pending.set(key, null);
+        scheduleRender();
+    }
+
+    has(key) {
+        return this.pending.has(key) ? this.pending.get(key) !== null : this.rows.has(key);
+    }
+
+    clear() {
+        this.rows.clear();
+        this.sorted = [];
+        this.pending.clear();
+        this.body.textContent = '';
+    }
+
+    render() {
+        for (const [key, update] of this.pending) {
+            let entry = this.rows.get(key);
+            if (update === null) {
+                if (entry) {
+                    entry.row.remove();
+                    this.sorted.splice(this.sorted.indexOf(entry), 1);
+                    this.rows.delete(key);
+                }
+                continue;
             }
-            signal = stats[msg].data[sig];
-            svalue = Math.round(signal.value*100000000)/100000000;
-            sstate = signal.state;
-            sunit = signal.unit;
-            if (sstate) {
-                rowHTML = `<td>${msg}</td><td>${sig}</td><td>${sstate}</td>`;
-            } else if (sunit) {
-                rowHTML = `<td>${msg}</td><td>${sig}</td><td>${svalue} ${sunit}</td>`;
-            } else {
-                rowHTML = `<td>${msg}</td><td>${sig}</td><td>${svalue}</td>`;
+            const [sortKey, texts] = update;
+            if (!entry) {
+                entry = this.insert(key, sortKey, texts.length);
+            }
+            for (let i = 0; i < texts.length; i++) {
+                if (entry.texts[i] !== texts[i]) {
+                    entry.texts[i] = texts[i];
+                    entry.cells[i].textContent = texts[i];
+                }
             }
-            
-            row.innerHTML = rowHTML;
         }
+        this.pending.clear();
     }
-    sortTable(table);
-}
-
-function sortTable(table) {
-    var rows, switching, i, x, y, shouldSwitch;
-    switching = true;
-    while (switching) {
-        switching = false;
-        rows = table.rows;
-        for (i = 1; i < (rows.length - 1); i++) {
-            shouldSwitch = false;
-            x = rows[i].getElementsByTagName("TD")[0];
-            y = rows[i + 1].getElementsByTagName("TD")[0];
-            if (x.innerHTML.toLowerCase() > y.innerHTML.toLowerCase()) {
-                shouldSwitch = true;
-                break;
+
+    insert(key, sortKey, columns) {
+        const row = document.createElement('tr');
+        const entry = {row: row, sortKey: sortKey, cells: [], texts: []};
+        for (let i = 0; i < columns; i++) {
+            entry.cells.push(row.appendChild(document.createElement('td')));
+            entry.texts.push('');
+        }
+        let lo = 0;
+        let hi = this.sorted.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (this.sorted[mid].sortKey < sortKey) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
             }
         }
-        if (shouldSwitch) {
-            rows[i].parentNode.insertBefore(rows[i + 1], rows[i]);
-            switching = true;
+        const next = lo < this.sorted.length ? this.sorted[lo].row : null;
+        this.body.insertBefore(row, next);
+        this.sorted.splice(lo, 0, entry);
+        this.rows.set(key, entry);
+        return entry;
+    }
+}
+
+const fpsView = new TableView('fps_stats');
+const systemView = new TableView('system_stats');
+const vehicleView = new TableView('vehicle_stats');
+const views = [fpsView, systemView, vehicleView];
+// raw system stat values, for the logging buttons
+let systemValues = {};
+let buttonState = null;
+let renderPending = false;
+
+function scheduleRender() {
+    if (!renderPending) {
+        renderPending = true;
+        requestAnimationFrame(renderViews);
+    }
+}
+
+function renderViews() {
+    renderPending = false;
+    for (const view of views) {
+        view.render();
+    }
+    updateButtons();
+}
+
+function clearViews() {
+    for (const view of views) {
+        view.clear();
+    }
+    systemValues = {};
+    updateButtons();
+}
+
+function updateFpsStats(fps) {
+    for (const channel in fps) {
+        fpsView.set(channel, channel.toLowerCase(), [channel, String(fps[channel])]);
+    }
+}
+
+function updateSystemStats(stats) {
+    for (const item in stats) {
+        const stat = stats[item];
+        // null: the stat is gone, e.g. a panda client disconnected
+        if (stat === null) {
+            delete systemValues[item];
+            systemView.delete(item);
+            continue;
         }
+        systemValues[item] = stat.value;
+        const text = stat.unit ? `${stat.value} ${stat.unit}` : `${stat.value}`;
+        systemView.set(item, item.toLowerCase(), [item, text]);
     }
 }
 
-function clearTable(table) {
-    table.tBodies[0].innerHTML = '';
+function updateVehicleStats(stats, onlyMissing = false) {
+    for (const msg in stats) {
+        const sortPrefix = `${msg.toLowerCase()}\u0000`;
+        for (const sig in stats[msg].data) {
+            if (onlyMissing && vehicleView.has(`${msg}.${sig}`)) {
+                continue;
+            }
+            const signal = stats[msg].data[sig];
+            let text;
+            if (signal.state) {
+                text = signal.state;
+            } else {
+                const value = Math.round(signal.value * 100000000) / 100000000;
+                text = signal.unit ? `${value} ${signal.unit}` : `${value}`;
+            }
+            vehicleView.set(`${msg}.${sig}`, sortPrefix + sig.toLowerCase(), [msg, sig, text]);
+        }
+    }
+}
+
+function loggingFlag(item) {
+    return item in systemValues ? systemValues[item] === true : null;
 }
 
 function updateButtons() {
-    loggingRow0 = document.getElementById('sys_stat_can0 logging');
-    loggingRow1 = document.getElementById('sys_stat_can1 logging');
-    autologRow0 = document.getElementById('sys_stat_can0 auto-log');
-    autologRow1 = document.getElementById('sys_stat_can1 auto-log');
-
-    if (loggingRow0) {
-        logging0 = (loggingRow0.getElementsByTagName("TD")[1].innerHTML.includes('true'));
-    } else {logging0 = null;}
-    if (loggingRow1) {
-        logging1 = (loggingRow1.getElementsByTagName("TD")[1].innerHTML.includes('true'));
-    } else {logging1 = null;}
-    if (autologRow0) {
-        autolog0 = (autologRow0.getElementsByTagName("TD")[1].innerHTML.includes('true'));
-    } else {autolog0 = null;}
-    if (autologRow1) {
-        autolog1 = (autologRow1.getElementsByTagName("TD")[1].innerHTML.includes('true'));
-    } else {autolog1 = null;}
+    const logging0 = loggingFlag('can0 logging');
+    const logging1 = loggingFlag('can1 logging');
+    const autolog0 = loggingFlag('can0 auto-log');
+    const autolog1 = loggingFlag('can1 auto-log');
+
+    const state = `${logging0} ${logging1} ${autolog0} ${autolog1}`;
+    if (state === buttonState) {
+        return;
+    }
+    buttonState = state;
 
     logging_buttons = document.getElementById('logging_buttons');
     autolog_buttons = document.getElementById('autolog_buttons');
@@ -0,0 +1,81 @@
+// Minimal msgpack decoder for the vehicle_delta stream (vehicle_stream_msgpack = True).
+// Handles everything msgpack-python produces for json-like data, no extension types.
+
+function msgpackDecode(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const utf8 = new TextDecoder();
+    let pos = 0;
+
+    function str(length) {
+        const value = utf8.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+
+    function bin(length) {
+        const value = bytes.slice(pos, pos + length);
+        pos += length;
+        return value;
+    }
+
+    function array(length) {
+        const value = new Array(length);
+        for (let i = 0; i < length; i++) {
+            value[i] = read();
+        }
+        return value;
+    }
+
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+
+    function read() {
+        const type = bytes[pos++];
+        if (type < 0x80) return type;
+        if (type < 0x90) return map(type & 0x0f);
+        if (type < 0xa0) return array(type & 0x0f);
+        if (type < 0xc0) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        let value;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+            case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+            case 0xcc: value = view.getUint8(pos); pos += 1; return value;
+            case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+            case 0xce: value = view.getUint32(pos); pos += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+            case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+            case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+            case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+        }
+        // types with a length prefix
+        const sizes = {
+            0xc4: 1, 0xc5: 2, 0xc6: 4,
+            0xd9: 1, 0xda: 2, 0xdb: 4,
+            0xdc: 2, 0xdd: 4,
+            0xde: 2, 0xdf: 4,
+        };
+        const size = sizes[type];
+        if (size === undefined) {
+            throw new Error(`unsupported msgpack type 0x${type.toString(16)}`);
+        }
+        const length = size === 1 ? view.getUint8(pos) : size === 2 ? view.getUint16(pos) : view.getUint32(pos);
+        pos += size;
+        if (type <= 0xc6) return bin(length);
+        if (type <= 0xdb) return str(length);
+        if (type <= 0xdd) return array(length);
+        return map(length);
+    }
+
+    return read();
+}
@@ -0,0 +1,261 @@
+// Live charts of full-rate signals (plot_stream.py) and of stored ones (timeseries.py).
+// Samples go into fixed size ring buffers and the canvas is redrawn at most once per
+// animation frame, so nothing is done per sample besides copying it.
+
+const sio = io({
+    transportOptions: {
+        polling: {
+            extraHeaders: {
+                'X-Username': 'browser plot'
+            }
+        }
+    }
+});
+
+const COLORS = ['#4fc3f7', '#ffb74d', '#81c784', '#e57373', '#ba68c8', '#fff176', '#4db6ac', '#f06292'];
+
+// signal -> {t: Float64Array, v: Float32Array, start, length}
+let traces = {};
+let traceOrder = [];
+let plotWindow = 10;
+let newestTime = 0;
+let drawPending = false;
+
+sio.on('connect', () => {
+    document.getElementById("status").innerHTML = 'Connected';
+    const params = new URLSearchParams(window.location.search);
+    if (params.get('signals')) {
+        document.getElementById('plot_signals').value = params.get('signals');
+        if (params.get('rate')) {
+            document.getElementById('plot_rate').value = params.get('rate');
+        }
+        if (params.get('window')) {
+            document.getElementById('plot_window').value = params.get('window');
+        }
+    }
+    if (document.getElementById('plot_signals').value) {
+        plotSubscribe();
+    }
+    loadStoredSignals();
+});
+
+sio.on('connect_error', (e) => {
+    document.getElementById("status").innerHTML = `Error: ${e.message}`;
+});
+
+sio.on('disconnect', () => {
+    document.getElementById("status").innerHTML = 'Disconnected';
+});
+
+sio.on('plot', (data) => {
+    for (const series of data.series) {
+        addSeries(series.signals, series.data);
+    }
+    if (!drawPending) {
+        drawPending = true;
+        requestAnimationFrame(draw);
+    }
+});
+
+function plotSubscribe() {
+    const signals = document.getElementById('plot_signals').value
+        .split(',').map((s) => s.trim()).filter((s) => s);
+    const rate = Number(document.getElementById('plot_rate').value);
+    plotWindow = Number(document.getElementById('plot_window').value) || 10;
+    sio.emit('plot_subscribe', {signals: signals, rate: rate}, (result) => {
+        if (result.error) {
+            document.getElementById("status").innerHTML = `Error: ${result.error}`;
+            return;
+        }
+        document.getElementById("status").innerHTML = `Connected, ${result.rate} samples/s`;
+        // room for a window of samples at the granted rate, plus some slack
+        const capacity = Math.ceil(plotWindow * result.rate * 1.5) + 64;
+        traces = {};
+        traceOrder = signals;
+        for (const signal of signals) {
+            traces[signal] = {t: new Float64Array(capacity), v: new Float32Array(capacity), start: 0, length: 0};
+        }
+        newestTime = 0;
+    });
+}
+
+// data: n float64 timestamps, then n float32 values for each signal
+function addSeries(signals, data) {
+    const n = data.byteLength / (8 + 4 * signals.length);
+    const times = new Float64Array(data, 0, n);
+    if (n && times[n - 1] > newestTime) {
+        newestTime = times[n - 1];
+    }
+    signals.forEach((signal, column) => {
+        const trace = traces[signal];
+        if (!trace) {
+            return;
+        }
+        const values = new Float32Array(data, 8 * n + 4 * n * column, n);
+        const capacity = trace.t.length;
+        for (let i = 0; i < n; i++) {
+            const at = (trace.start + trace.length) % capacity;
+            trace.t[at] = times[i];
+            trace.v[at] = values[i];
+            if (trace.length < capacity) {
+                trace.length++;
+            } else {
+                trace.start = (trace.start + 1) % capacity;
+            }
+        }
+    });
+}
+
+// every signal gets its own lane, scaled to its visible range
+function draw() {
+    drawPending = false;
+    const canvas = document.getElementById('plot');
+    const ctx = canvas.getContext('2d');
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    if (!traceOrder.length) {
+        return;
+    }
+    const laneHeight = canvas.height / traceOrder.length;
+    const oldest = newestTime - plotWindow;
+    const xScale = canvas.width / plotWindow;
+    ctx.font = '12px sans-serif';
+
+    traceOrder.forEach((signal, lane) => {
+        const trace = traces[signal];
+        const capacity = trace.t.length;
+        const top = lane * laneHeight;
+        let min = Infinity;
+        let max = -Infinity;
+        let last = NaN;
+        for (let k = 0; k < trace.length; k++) {
+            const i = (trace.start + k) % capacity;
+            const v = trace.v[i];
+            if (trace.t[i] < oldest || Number.isNaN(v)) {
+                continue;
+            }
+            if (v < min) min = v;
+            if (v > max) max = v;
+            last = v;
+        }
+        ctx.strokeStyle = 'rgb(80, 80, 80)';
+        ctx.beginPath();
+        ctx.moveTo(0, top + laneHeight);
+        ctx.lineTo(canvas.width, top + laneHeight);
+        ctx.stroke();
+        ctx.fillStyle = COLORS[lane % COLORS.length];
+        ctx.fillText(`${signal}: ${last}  [${min}, ${max}]`, 4, top + 14);
+        if (min === Infinity) {
+            return;
+        }
+        const span = max - min || 1;
+        const yScale = (laneHeight - 24) / span;
+        const bottom = top + laneHeight - 4;
+
+        ctx.strokeStyle = COLORS[lane % COLORS.length];
+        ctx.beginPath();
+        let moved = false;
+        for (let k = 0; k < trace.length; k++) {
+            const i = (trace.start + k) % capacity;
+            const v = trace.v[i];
+            if (trace.t[i] < oldest || Number.isNaN(v)) {
+                moved = false;
+                continue;
+            }
+            const x = (trace.t[i] - oldest) * xScale;
+            const y = bottom - (v - min) * yScale;
+            if (moved) {
+                ctx.lineTo(x, y);
+            } else {
+                ctx.moveTo(x, y);
+                moved = true;
+            }
+        }
+        ctx.stroke();
+    });
+}
+
+// stored signals, see timeseries.py
+
+let storedSignals = {};
+
+function loadStoredSignals() {
+    sio.emit('timeseries_signals', (signals) => {
+        const select = document.getElementById('history_signal');
+        select.textContent = '';
+        storedSignals = {};
+        for (const info of signals) {
+            storedSignals[info.signal] = info;
+            const option = document.createElement('option');
+            option.value = info.signal;
+            option.textContent = info.signal;
+            select.appendChild(option);
+        }
+    });
+}
+
+function historyQuery() {
+    const info = storedSignals[document.getElementById('history_signal').value];
+    if (!info) {
+        return;
+    }
+    const hours = Number(document.getElementById('history_hours').value) || 2;
+    const canvas = document.getElementById('history');
+    const request = {
+        signal: info.signal,
+        start: info.end - hours * 3600,
+        end: info.end,
+        max_points: canvas.width * 2,
+    };
+    sio.emit('timeseries_query', request, (result) => {
+        if (result.error) {
+            document.getElementById('history_status').textContent = `Error: ${result.error}`;
+            return;
+        }
+        const n = result.data.byteLength / (8 + 4 * result.columns.length);
+        document.getElementById('history_status').textContent = `${n} points, ${result.resolution}`;
+        drawHistory(canvas, request.start, request.end, result, n);
+    });
+}
+
+// raw values as a line, rollups as a min/max band around the mean
+function drawHistory(canvas, start, end, result, n) {
+    const ctx = canvas.getContext('2d');
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    if (!n) {
+        return;
+    }
+    const times = new Float64Array(result.data, 0, n);
+    const column = (name) => new Float32Array(result.data, 8 * n + 4 * n * result.columns.indexOf(name), n);
+    const isRaw = result.resolution === 'raw';
+    const low = isRaw ? column('value') : column('min');
+    const high = isRaw ? low : column('max');
+    const line = isRaw ? low : column('mean');
+    let min = Infinity;
+    let max = -Infinity;
+    for (let i = 0; i < n; i++) {
+        if (low[i] < min) min = low[i];
+        if (high[i] > max) max = high[i];
+    }
+    const xScale = canvas.width / (end - start);
+    const yScale = (canvas.height - 24) / (max - min || 1);
+    const x = (i) => (times[i] - start) * xScale;
+    const y = (v) => canvas.height - 4 - (v - min) * yScale;
+
+    if (!isRaw) {
+        ctx.fillStyle = 'rgba(79, 195, 247, 0.3)';
+        ctx.beginPath();
+        ctx.moveTo(x(0), y(high[0]));
+        for (let i = 1; i < n; i++) ctx.lineTo(x(i), y(high[i]));
+        for (let i = n - 1; i >= 0; i--) ctx.lineTo(x(i), y(low[i]));
+        ctx.closePath();
+        ctx.fill();
+    }
+    ctx.strokeStyle = COLORS[0];
+    ctx.beginPath();
+    ctx.moveTo(x(0), y(line[0]));
+    for (let i = 1; i < n; i++) ctx.lineTo(x(i), y(line[i]));
+    ctx.stroke();
+    ctx.fillStyle = COLORS[0];
+    ctx.font = '12px sans-serif';
+    ctx.fillText(`${result.signal}  [${min}, ${max}]`, 4, 14);
+}
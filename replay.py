@@ -0,0 +1,107 @@
+"""Replay pacing for the --test pipeline.
+
+Every rx client replaying a recording gets a ReplayClock. The clocks of a
+run share a wall clock start and a data origin (the earliest first frame
+of all replayed channels, agreed through redis), so channels stay time
+aligned at any speed:
+
+    speed > 0: a frame recorded at t is due at start + (t - origin) / speed
+    speed = 0: frames are due immediately, but a channel more than
+               max_skew seconds (of recorded time) ahead of the slowest
+               channel waits for it
+"""
+
+from time import sleep, time
+from typing import List, Optional
+
+import redis
+
+_KEY_EXPIRY = 24 * 60 * 60
+_PROGRESS_INTERVAL = 0.05
+_POLL = 0.001
+
+
+class ReplayClock:
+    def __init__(
+        self,
+        red: redis.StrictRedis,
+        channel: str,
+        first_timestamp: float,
+        speed: float = 1.0,
+        start: Optional[float] = None,
+        channels: Optional[List[str]] = None,
+        max_skew: float = 0.1,
+    ) -> None:
+        if speed < 0:
+            raise ValueError("replay speed must not be negative")
+        self.red = red
+        self.channel = channel
+        self.speed = speed
+        self.start = start if start is not None else time()
+        self.channels = channels or [channel]
+        self.max_skew = max_skew
+        self._key = f"replay:{self.start}"
+        self._peer_progress = {}
+        self._last_progress = None
+        self._last_progress_check = 0.0
+        self.origin = self._agree_origin(first_timestamp)
+        self.replayed_until = self.origin
+
+    def _agree_origin(self, first_timestamp: float) -> float:
+        if len(self.channels) == 1:
+            return first_timestamp
+        key = f"{self._key}:origin"
+        self.red.hset(key, self.channel, first_timestamp)
+        self.red.expire(key, _KEY_EXPIRY)
+        deadline = time() + 10
+        while time() < deadline:
+            origins = self.red.hgetall(key)
+            if len(origins) >= len(self.channels):
+                return min(float(x) for x in origins.values())
+            sleep(0.05)
+        return first_timestamp
+
+    def delay(self, timestamp: float) -> float:
+        """Seconds to wait before the frame recorded at timestamp is due."""
+        if self.speed:
+            return self.start + (timestamp - self.origin) / self.speed - time()
+        if len(self.channels) == 1:
+            return 0.0
+        self._publish_progress(timestamp)
+        if timestamp - self._slowest_peer() > self.max_skew:
+            return _POLL
+        return 0.0
+
+    def emitted(self, timestamp: float) -> None:
+        if timestamp > self.replayed_until:
+            self.replayed_until = timestamp
+
+    def finish(self) -> None:
+        """Stop holding back the other channels."""
+        if not self.speed and len(self.channels) > 1:
+            self.red.hset(f"{self._key}:progress", self.channel, "inf")
+
+    def _publish_progress(self, timestamp: float) -> None:
+        if (
+            self._last_progress is not None
+            and timestamp - self._last_progress < _PROGRESS_INTERVAL
+        ):
+            return
+        key = f"{self._key}:progress"
+        self.red.hset(key, self.channel, timestamp)
+        self.red.expire(key, _KEY_EXPIRY)
+        self._last_progress = timestamp
+
+    def _slowest_peer(self) -> float:
+        now = time()
+        if now - self._last_progress_check >= _POLL:
+            progress = self.red.hgetall(f"{self._key}:progress")
+            self._peer_progress = {
+                k.decode(): float(v)
+                for k, v in progress.items()
+                if k.decode() != self.channel
+            }
+            self._last_progress_check = now
+        peers = [self._peer_progress.get(c, self.origin) for c in self.channels]
+        peers = [p for c, p in zip(self.channels, peers) if c != self.channel]
+        return min(peers) if peers else float("inf")
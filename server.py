@@ -1,13 +1,27 @@
 import logging
+from time import time
 
+import redis
 import socketio
 
+import config as cfg
+import plot_stream
+import snapshot
+import subscriptions
+import timeseries
+import vehicle_stream
 from logging_setup import setup_logging
 
 setup_logging()
 logger = logging.getLogger("canserver.socketio")
 
-sio = socketio.Server()
+# with a message queue, other processes emit to clients directly (see
+# message_queue.py), and several server processes can share the clients
+client_manager = None
+if cfg.sio_message_queue:
+    client_manager = socketio.RedisManager(cfg.sio_message_queue)
+sio = socketio.Server(client_manager=client_manager)
+red = redis.StrictRedis("localhost", 6379)
 app = socketio.WSGIApp(
     sio,
     static_files={
@@ -32,10 +46,109 @@ def connect(sid, environ):
 def disconnect(sid):
     with sio.session(sid) as s:
         username = s["username"]
+        room = s.pop("subscription", None)
+        plot_room = s.pop("plot_subscription", None)
+    if room is not None:
+        subscriptions.remove_subscriber(red, room)
+    if plot_room is not None:
+        subscriptions.remove_subscriber(red, plot_room, plot_stream.KIND)
 
     logger.warning(f"{username} disconnected")
 
 
+@sio.event
+def vehicle_schema(sid):
+    return vehicle_stream.load_schema(red)
+
+
+@sio.event
+def subscribe(sid, request):
+    """Replace the client's vehicle data subscription, see subscriptions.py"""
+    try:
+        room, subscription = subscriptions.normalize(request)
+    except ValueError as e:
+        return {"error": str(e)}
+    with sio.session(sid) as s:
+        old_room = s.get("subscription")
+        s["subscription"] = room
+    if old_room != room:
+        sio.enter_room(sid, room)
+        subscriptions.add_subscriber(red, room, subscription)
+        if old_room is not None:
+            sio.leave_room(sid, old_room)
+            subscriptions.remove_subscriber(red, old_room)
+    if request.get("snapshot"):
+        return {"room": room, "snapshot": snapshot.load(red, subscription, time())}
+    return {"room": room}
+
+
+@sio.event
+def unsubscribe(sid):
+    with sio.session(sid) as s:
+        room = s.pop("subscription", None)
+    if room is not None:
+        sio.leave_room(sid, room)
+        subscriptions.remove_subscriber(red, room)
+
+
+@sio.event
+def plot_subscribe(sid, request):
+    """Replace the client's live plot signals, see plot_stream.py"""
+    try:
+        room, subscription = plot_stream.normalize(request)
+    except ValueError as e:
+        return {"error": str(e)}
+    with sio.session(sid) as s:
+        old_room = s.get("plot_subscription")
+        s["plot_subscription"] = room
+    if old_room != room:
+        sio.enter_room(sid, room)
+        subscriptions.add_subscriber(red, room, subscription, plot_stream.KIND)
+        if old_room is not None:
+            sio.leave_room(sid, old_room)
+            subscriptions.remove_subscriber(red, old_room, plot_stream.KIND)
+    return {"room": room, "rate": subscription["rate"]}
+
+
+@sio.event
+def plot_unsubscribe(sid):
+    with sio.session(sid) as s:
+        room = s.pop("plot_subscription", None)
+    if room is not None:
+        sio.leave_room(sid, room)
+        subscriptions.remove_subscriber(red, room, plot_stream.KIND)
+
+
+@sio.event
+def timeseries_signals(sid):
+    return timeseries.signals(cfg.timeseries_dir)
+
+
+@sio.event
+def timeseries_query(sid, request):
+    """Stored samples or rollups of a signal, see timeseries.py"""
+    try:
+        resolution, records = timeseries.query(
+            cfg.timeseries_dir,
+            str(request["signal"]),
+            request.get("start"),
+            request.get("end"),
+            min(int(request.get("max_points", 2000)), 20000),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": str(e)}
+    columns = [name for name in records.dtype.names[1:] if name != "count"]
+    return {
+        "signal": request["signal"],
+        "resolution": resolution,
+        "columns": columns,
+        "data": plot_stream.pack(records, columns),
+    }
+
+
+# relays for clients that don't use the message queue
+
+
 @sio.event
 def broadcast_message(sid, message):
     with sio.session(sid) as s:
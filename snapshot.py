@@ -0,0 +1,71 @@
+"""Last values of stats and decoded signals, for clients that just connected.
+
+Every process's latest "stats" emit (see message_queue.Emitter) and the
+latest decoded value of every message (CanDecoder) are kept in redis. A
+client that subscribes with {"snapshot": true} gets them back in the
+"subscribe" ack, so a fresh page fills its tables at once and then
+follows the live updates:
+
+    {"stats": <stats dict of all processes>,
+     "vehicle": <vehicle_stats dict of the subscribed signals>}
+
+Entries not refreshed within cfg.snapshot_max_age seconds are left out,
+e.g. stats of a process that stopped or messages nobody decodes anymore.
+"""
+
+import json
+from collections import namedtuple
+
+import config as cfg
+import tools
+from subscriptions import Room
+
+STATS_KEY = "snapshot:stats"
+VEHICLE_KEY = "snapshot:vehicle"
+
+# stands in for a DecodePlan when resolving subscriptions against stored messages
+_Message = namedtuple("_Message", "name key signals")
+
+
+def save_stats(red, name: str, data: dict, now: float) -> None:
+    red.hset(STATS_KEY, name, json.dumps({"updated": now, "stats": data}))
+
+
+def save_vehicle(red, decoded_batch: dict, names: dict, now: float) -> None:
+    """Store a vehicle_stats dict, names maps its frame keys to dbc names."""
+    red.hset(
+        VEHICLE_KEY,
+        mapping={
+            key: json.dumps(
+                {
+                    "updated": now,
+                    "name": names[key],
+                    "data": frame["data"],
+                    "timestamp": frame["timestamp"],
+                }
+            )
+            for key, frame in decoded_batch.items()
+        },
+    )
+
+
+def load(red, subscription: dict, now: float) -> dict:
+    """The snapshot for a subscription from subscriptions.normalize()."""
+    oldest = now - cfg.snapshot_max_age
+    stats = {}
+    for entry in red.hvals(STATS_KEY):
+        entry = json.loads(entry)
+        if entry["updated"] >= oldest:
+            tools.deep_update(stats, entry["stats"])
+
+    messages = {}
+    vehicle = {}
+    for key, entry in red.hgetall(VEHICLE_KEY).items():
+        entry = json.loads(entry)
+        if entry["updated"] >= oldest:
+            key = key.decode()
+            messages[key] = _Message(entry["name"], key, entry["data"])
+            vehicle[key] = {"data": entry["data"], "timestamp": entry["timestamp"]}
+    room = Room.resolve("snapshot", subscription, messages)
+    vehicle = room.select(vehicle, {key: key for key in vehicle})
+    return {"stats": stats, "vehicle": vehicle}
@@ -0,0 +1,157 @@
+"""Which decoded signals each socket.io client wants to see.
+
+Clients emit "subscribe" to server.py with either a list of selectors or the
+name of a dashboard from cfg.dashboards, and the format they want:
+
+    {"signals": ["ID257DIspeed", "118.DI_gear"], "format": "stats"}
+    {"dashboard": "driving", "format": "delta"}
+
+A selector is "*" (every message in cfg.can_filter), a message (dbc name or
+frame key) or "<message>.<signal>". Every distinct subscription is a room.
+server.py keeps the rooms, their subscriptions and subscriber counts in
+redis and publishes on CHANGED_CHANNEL when they change. CanDecoder then
+only decodes the messages and signals some room wants and emits each room
+its own payload: "vehicle_stats" dicts, or "vehicle_delta" updates for
+format "delta" when cfg.vehicle_stream = "delta".
+"""
+
+import hashlib
+import json
+from typing import Dict, FrozenSet, Iterable, Optional
+
+import config as cfg
+
+# subscriptions of each kind ("vehicle", "plot") are in "<kind>_subscriptions"
+# and their subscriber counts in "<kind>_subscribers"
+KINDS = ("vehicle", "plot")
+CHANGED_CHANNEL = "vehicle_subscriptions_changed"
+
+FORMATS = ("stats", "delta")
+
+
+def normalize(request) -> (str, dict):
+    """The room and the stored subscription for a "subscribe" request."""
+    if not isinstance(request, dict):
+        raise ValueError("subscription must be an object")
+    fmt = request.get("format", "stats")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format '{fmt}'")
+    if request.get("dashboard") is not None:
+        name = request["dashboard"]
+        if name not in cfg.dashboards:
+            raise ValueError(f"unknown dashboard '{name}'")
+        signals = sorted(set(cfg.dashboards[name]))
+        room = f"dashboard:{name}:{fmt}"
+    else:
+        signals = request.get("signals")
+        if not isinstance(signals, list) or not all(
+            isinstance(s, str) for s in signals
+        ):
+            raise ValueError("signals must be a list of strings")
+        signals = sorted(set(signals))
+        digest = hashlib.sha1(json.dumps([signals, fmt]).encode()).hexdigest()
+        room = f"signals:{digest[:8]}"
+    return room, {"signals": signals, "format": fmt}
+
+
+def add_subscriber(red, room: str, subscription: dict, kind="vehicle") -> None:
+    pipe = red.pipeline()
+    pipe.hset(f"{kind}_subscriptions", room, json.dumps(subscription))
+    pipe.hincrby(f"{kind}_subscribers", room, 1)
+    if pipe.execute()[1] == 1:
+        red.publish(CHANGED_CHANNEL, room)
+
+
+def remove_subscriber(red, room: str, kind="vehicle") -> None:
+    if red.hincrby(f"{kind}_subscribers", room, -1) <= 0:
+        pipe = red.pipeline()
+        pipe.hdel(f"{kind}_subscribers", room)
+        pipe.hdel(f"{kind}_subscriptions", room)
+        pipe.publish(CHANGED_CHANNEL, room)
+        pipe.execute()
+
+
+def clear(red) -> None:
+    for kind in KINDS:
+        red.delete(f"{kind}_subscriptions", f"{kind}_subscribers")
+    red.publish(CHANGED_CHANNEL, "")
+
+
+def load(red, kind="vehicle") -> Dict[str, dict]:
+    return {
+        room.decode(): json.loads(subscription)
+        for room, subscription in red.hgetall(f"{kind}_subscriptions").items()
+    }
+
+
+class Room:
+    """A subscription resolved against the decode plans.
+
+    wanted maps frame ids to the signal names the room wants, or None for
+    all of the message's signals. indexes are the room's VehicleStream
+    schema indexes, set by the decoder for the delta stream.
+    """
+
+    __slots__ = ("name", "format", "wanted", "indexes")
+
+    def __init__(self, name: str, fmt: str, wanted: Dict[int, Optional[FrozenSet]]):
+        self.name = name
+        self.format = fmt
+        self.wanted = wanted
+        self.indexes = None
+
+    @classmethod
+    def resolve(cls, name: str, subscription: dict, plans: dict) -> "Room":
+        by_name = {}
+        for frame_id, plan in plans.items():
+            by_name[plan.name] = frame_id
+            by_name[plan.key] = frame_id
+        wanted = {}
+        for selector in subscription["signals"]:
+            if selector == "*":
+                wanted = {frame_id: None for frame_id in plans}
+                break
+            message, _, signal = selector.partition(".")
+            frame_id = by_name.get(message, by_name.get(message.upper()))
+            if frame_id is None:
+                continue
+            if not signal:
+                wanted[frame_id] = None
+            elif signal in plans[frame_id].signals:
+                if frame_id not in wanted:
+                    wanted[frame_id] = frozenset((signal,))
+                elif wanted[frame_id] is not None:
+                    wanted[frame_id] |= {signal}
+        return cls(name, subscription["format"], wanted)
+
+    def select(self, decoded_batch: dict, keys: Dict[str, int]) -> dict:
+        """The part of a vehicle_stats dict this room wants."""
+        selected = {}
+        for key, frame in decoded_batch.items():
+            frame_id = keys[key]
+            if frame_id not in self.wanted:
+                continue
+            signals = self.wanted[frame_id]
+            if signals is None:
+                selected[key] = frame
+                continue
+            data = {k: v for k, v in frame["data"].items() if k in signals}
+            if data:
+                selected[key] = {"data": data, "timestamp": frame["timestamp"]}
+        return selected
+
+
+def merge(rooms: Iterable[Room]) -> Dict[int, Optional[FrozenSet]]:
+    """Signals to decode per frame id for all rooms, None for all signals."""
+    merged = {}
+    for room in rooms:
+        for frame_id, signals in room.wanted.items():
+            if frame_id in merged:
+                current = merged[frame_id]
+                if current is None or signals is None:
+                    merged[frame_id] = None
+                else:
+                    merged[frame_id] = current | signals
+            else:
+                merged[frame_id] = signals
+    return merged
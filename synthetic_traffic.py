@@ -0,0 +1,170 @@
+"""Synthetic CAN traffic generated from the dbc, for load testing without a car.
+
+SyntheticTraffic is an iterator of timestamped can.Message objects, like
+ASCReader, so can_rx_client.py replays it through the same ReplayClock.
+It sends:
+
+- the wanted messages (usually cfg.can_filter) at their dbc cycle time,
+  cfg.synthetic_rates, or 10 Hz, with every signal doing a random walk
+  inside its range (enum signals occasionally change state)
+- background traffic from the remaining dbc messages, at equal rates chosen
+  so the estimated bus load reaches bus_load of the bitrate
+
+Bus load is estimated with worst case bit stuffing, so 1.0 is a full bus.
+"""
+
+import heapq
+import random
+from time import time
+from typing import Dict, Iterable, Iterator, Optional
+
+import can
+
+_DEFAULT_RATE = 10.0
+_WALK_STEP = 0.01
+_STATE_CHANGE_PROBABILITY = 0.01
+
+
+def frame_bits(dlc: int, extended: bool = False) -> int:
+    """Bits on the wire for a classic data frame, with worst case stuffing."""
+    overhead = 67 if extended else 47
+    # sof through crc are subject to stuffing, not the fixed form fields
+    stuffable = overhead - 13 + 8 * dlc
+    return overhead + 8 * dlc + (stuffable - 1) // 4
+
+
+class _SignalWalk:
+    def __init__(self, sig, rng: random.Random) -> None:
+        self.name = sig.name
+        self.rng = rng
+        self.choices = list(sig.choices) if sig.choices else None
+        if sig.is_float:
+            low, high = -1000.0, 1000.0
+        else:
+            if sig.is_signed:
+                raw_low, raw_high = (
+                    -(1 << (sig.length - 1)),
+                    (1 << (sig.length - 1)) - 1,
+                )
+            else:
+                raw_low, raw_high = 0, (1 << sig.length) - 1
+            ends = (raw_low * sig.scale + sig.offset, raw_high * sig.scale + sig.offset)
+            low, high = min(ends), max(ends)
+        if sig.minimum is not None and sig.maximum is not None:
+            if sig.minimum < sig.maximum:
+                low, high = max(low, sig.minimum), min(high, sig.maximum)
+        self.low = low
+        self.high = high
+        if self.choices:
+            self.value = rng.choice(self.choices)
+        else:
+            self.value = rng.uniform(low, high)
+
+    def step(self):
+        if self.choices:
+            if self.rng.random() < _STATE_CHANGE_PROBABILITY:
+                self.value = self.rng.choice(self.choices)
+            return self.value
+        span = self.high - self.low
+        value = self.value + self.rng.gauss(0, span * _WALK_STEP)
+        self.value = min(max(value, self.low), self.high)
+        return self.value
+
+
+class _Source:
+    def __init__(self, db_msg, rate: float, walk: bool, rng: random.Random) -> None:
+        self.db_msg = db_msg
+        self.period = 1 / rate
+        self.rng = rng
+        self.arbitration_id = db_msg.frame_id
+        self.is_extended_id = db_msg.is_extended_frame
+        self.dlc = min(db_msg.length, 8)
+        # multiplexed messages get random payloads, their signals need a mux
+        self.walks = None
+        if walk and not db_msg.is_multiplexed():
+            self.walks = [_SignalWalk(sig, rng) for sig in db_msg.signals]
+        self.data = bytes(rng.getrandbits(8) for _ in range(self.dlc))
+
+    def next_data(self) -> bytes:
+        if self.walks is None:
+            return self.data
+        values = {walk.name: walk.step() for walk in self.walks}
+        try:
+            return bytes(self.db_msg.encode(values, strict=False))[: self.dlc]
+        except Exception:
+            self.walks = None
+            return self.data
+
+
+class SyntheticTraffic:
+    def __init__(
+        self,
+        db,
+        channel: int = 0,
+        include: Iterable[str] = (),
+        rates: Optional[Dict[str, float]] = None,
+        bus_load: float = 0.5,
+        bitrate: int = 500000,
+        start: Optional[float] = None,
+        duration: Optional[float] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        if not 0 <= bus_load <= 1:
+            raise ValueError("bus_load must be between 0 and 1")
+        rates = rates or {}
+        self.channel = channel
+        self.start = start if start is not None else time()
+        self.duration = duration
+        rng = random.Random(seed)
+        self._sources = []
+
+        included = set(include)
+        load_bits = 0.0
+        for name in included:
+            db_msg = db.get_message_by_name(name)
+            rate = rates.get(name) or _cycle_rate(db_msg) or _DEFAULT_RATE
+            source = _Source(db_msg, rate, True, rng)
+            self._sources.append(source)
+            load_bits += rate * frame_bits(source.dlc, source.is_extended_id)
+
+        background = [
+            m for m in db.messages if m.name not in included and m.length <= 8
+        ]
+        spare_bits = bus_load * bitrate - load_bits
+        if background and spare_bits > 0:
+            bits_per_round = sum(
+                frame_bits(m.length, m.is_extended_frame) for m in background
+            )
+            rate = spare_bits / bits_per_round
+            for db_msg in background:
+                self._sources.append(_Source(db_msg, rate, False, rng))
+            load_bits += rate * bits_per_round
+        self.bus_load = load_bits / bitrate
+
+    def __iter__(self) -> Iterator[can.Message]:
+        # (due time, tiebreak, source), staggered so ids don't all collide at 0
+        queue = [
+            (self.start + i * source.period / len(self._sources), i, source)
+            for i, source in enumerate(self._sources)
+        ]
+        heapq.heapify(queue)
+        end = self.start + self.duration if self.duration else None
+        while queue:
+            due, i, source = queue[0]
+            if end is not None and due >= end:
+                return
+            heapq.heapreplace(queue, (due + source.period, i, source))
+            yield can.Message(
+                timestamp=due,
+                arbitration_id=source.arbitration_id,
+                is_extended_id=source.is_extended_id,
+                dlc=source.dlc,
+                data=source.next_data(),
+                channel=self.channel,
+            )
+
+
+def _cycle_rate(db_msg) -> Optional[float]:
+    if db_msg.cycle_time:
+        return 1000 / db_msg.cycle_time
+    return None
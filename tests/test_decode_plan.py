@@ -0,0 +1,88 @@
+import random
+
+import cantools
+import pytest
+
+from batch_decoder import _SignalColumn
+from can_decoder_client import DecodePlan
+
+DBC = """VERSION ""
+
+BU_: VCU
+
+BO_ 373 ID175WheelSpeed: 8 VCU
+ SG_ WheelSpeedFL : 0|16@1+ (0.04,0) [0|0] "km/h" VCU
+ SG_ WheelSpeedFR : 16|16@1+ (0.04,0) [0|0] "km/h" VCU
+ SG_ SteeringAngle : 39|14@0- (0.1,-5) [0|0] "deg" VCU
+ SG_ Gear : 50|3@1+ (1,0) [0|7] "" VCU
+
+BO_ 306 ID132HVBattAmpVolt: 8 VCU
+ SG_ Mux M : 0|2@1+ (1,0) [0|3] "" VCU
+ SG_ Voltage m0 : 8|16@1+ (0.01,0) [0|0] "V" VCU
+ SG_ Current m1 : 8|16@1- (0.1,0) [0|0] "A" VCU
+ SG_ Temp m1 : 31|8@0+ (1,-40) [0|0] "C" VCU
+
+VAL_ 373 Gear 1 "P" 2 "R" 3 "N" 4 "D" ;
+"""
+
+
+@pytest.fixture(scope="module")
+def db():
+    return cantools.database.load_string(DBC, "dbc")
+
+
+def _payload(rng, length):
+    return bytes(rng.getrandbits(8) for _ in range(length))
+
+
+@pytest.mark.parametrize("name", ["ID175WheelSpeed", "ID132HVBattAmpVolt"])
+def test_matches_cantools(db, name):
+    db_msg = db.get_message_by_name(name)
+    plan = DecodePlan(db_msg)
+    rng = random.Random(1)
+    for _ in range(200):
+        data = _payload(rng, db_msg.length)
+        try:
+            expected = db_msg.decode(data, decode_choices=False)
+        except cantools.database.DecodeError:
+            # multiplexer value without signals
+            continue
+        decoded = plan.decode(data)
+        assert decoded.keys() == expected.keys()
+        for signal, value in expected.items():
+            assert decoded[signal] == pytest.approx(value)
+
+
+def test_unsubscribed_signal_not_decoded(db, monkeypatch):
+    plan = DecodePlan(db.get_message_by_name("ID175WheelSpeed"))
+    plan.select(frozenset(["WheelSpeedFR"]))
+    extracted = []
+    extract_one = _SignalColumn.extract_one
+
+    def spy(self, little, big):
+        extracted.append(self.name)
+        return extract_one(self, little, big)
+
+    monkeypatch.setattr(_SignalColumn, "extract_one", spy)
+    data = bytes([0, 0, 0x10, 0x27, 0, 0, 0, 0])
+    assert plan.decode(data) == {"WheelSpeedFR": pytest.approx(400.0)}
+    assert extracted == ["WheelSpeedFR"]
+
+
+def test_select_all_again(db):
+    db_msg = db.get_message_by_name("ID175WheelSpeed")
+    plan = DecodePlan(db_msg)
+    plan.select(frozenset(["Gear"]))
+    plan.select(None)
+    data = _payload(random.Random(2), db_msg.length)
+    assert plan.decode(data).keys() == db_msg.decode(data).keys()
+
+
+def test_multiplexed_signal_decodes_its_multiplexer(db):
+    db_msg = db.get_message_by_name("ID132HVBattAmpVolt")
+    plan = DecodePlan(db_msg)
+    plan.select(frozenset(["Current"]))
+    assert plan.decode(bytes([1, 0xE8, 0x03, 0, 0, 0, 0, 0])) == {
+        "Current": pytest.approx(100.0)
+    }
+    assert plan.decode(bytes([0, 0xE8, 0x03, 0, 0, 0, 0, 0])) == {}
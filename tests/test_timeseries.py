@@ -0,0 +1,74 @@
+import numpy as np
+
+import timeseries
+
+DTYPE = np.dtype([("timestamp", "<f8"), ("speed", "<f8"), ("mux", "<f8")])
+
+
+def _samples(start, count, rate=10):
+    samples = np.empty(count, dtype=DTYPE)
+    samples["timestamp"] = start + np.arange(count) / rate
+    samples["speed"] = np.arange(count)
+    samples["mux"] = np.nan
+    return samples
+
+
+def test_append_and_query(tmp_path):
+    writer = timeseries.TimeSeriesWriter(str(tmp_path))
+    assert writer.append("ID257", _samples(1000, 600)) == 600
+    writer.close()
+
+    assert timeseries.signals(str(tmp_path)) == [
+        {"signal": "ID257.speed", "start": 1000.0, "end": 1059.9, "count": 600}
+    ]
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed", 1010, 1020)
+    assert resolution == "raw"
+    assert records["timestamp"][0] == 1010 and len(records) == 101
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed", max_points=100)
+    assert resolution == "1s" and len(records) == 60
+    assert records["count"].sum() == 600
+
+
+def test_late_samples_dropped(tmp_path):
+    writer = timeseries.TimeSeriesWriter(str(tmp_path))
+    writer.append("ID257", _samples(1000, 50))
+    # overlaps the last half second of what is stored
+    assert writer.append("ID257", _samples(1004.5, 10)) == 5
+    assert writer.dropped == 5
+    writer.close()
+    raw = timeseries._map(str(tmp_path / "ID257.speed"), "raw")
+    assert np.all(np.diff(raw["timestamp"]) > 0)
+
+
+def test_stored_clock_ahead(tmp_path):
+    # an earlier run stored samples with a clock an hour ahead
+    writer = timeseries.TimeSeriesWriter(str(tmp_path))
+    writer.append("ID257", _samples(4600, 100))
+    writer.close()
+
+    writer = timeseries.TimeSeriesWriter(str(tmp_path))
+    assert writer.append("ID257", _samples(1000, 100)) == 100
+    assert writer.append("ID257", _samples(1010, 100)) == 100
+    assert writer.dropped == 0
+    writer.close()
+
+    (info,) = timeseries.signals(str(tmp_path))
+    assert (info["start"], info["end"], info["count"]) == (1000.0, 4609.9, 300)
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed", 1000, 1020)
+    assert resolution == "raw" and len(records) == 200
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed")
+    assert len(records) == 300
+    assert np.all(np.diff(records["timestamp"]) >= 0)
+
+
+def test_clock_stepped_back(tmp_path):
+    writer = timeseries.TimeSeriesWriter(str(tmp_path))
+    writer.append("ID257", _samples(2000, 100))
+    writer.time_reset()
+    assert writer.append("ID257", _samples(1000, 100)) == 100
+    writer.close()
+
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed", 999, 1011)
+    assert resolution == "raw" and len(records) == 100
+    resolution, records = timeseries.query(str(tmp_path), "ID257.speed", max_points=50)
+    assert resolution == "1s" and records["count"].sum() == 200
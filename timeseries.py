@@ -0,0 +1,344 @@
+"""On-disk time series of decoded signals, with 1 s and 1 min rollups.
+
+CanDecoder decodes the messages in cfg.timeseries_filter at full rate with
+a BatchDecoder and appends every signal to its own directory under
+cfg.timeseries_dir:
+
+    <message>.<signal>/raw.bin    RAW records, every sample
+    <message>.<signal>/1s.bin     ROLLUP records, one per second
+    <message>.<signal>/1min.bin   ROLLUP records, one per minute
+
+The files are plain arrays of fixed-width records that only ever grow, so
+readers map them with np.memmap and find a time range with a binary search
+on the timestamps, without reading the rest of the file. A rollup record
+is written once its bucket is complete. Writes are buffered and flushed
+every FLUSH_INTERVAL seconds, readers see them from then on.
+
+Timestamps must only increase within a file for the binary search to work.
+When a sample is more than MAX_LATE seconds older than the last stored one
+of its signal (the clock was stepped back by timesync in main.py, or an
+earlier run had a clock that was ahead), the files are moved to
+
+    <message>.<signal>/segments/<n>/    an earlier segment, same files
+
+and new ones are started. Samples less late than that are dropped and
+counted in TimeSeriesWriter.dropped. server.py answers "timeseries_signals"
+and "timeseries_query" with signals() and query(), which read every
+segment, picking the finest resolution that fits the number of points asked
+for, so plotting a whole drive reads a few thousand rollups instead of every
+sample.
+
+Usage:
+    python timeseries.py [dir]                      summary of the stored signals
+"""
+
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import config as cfg
+
+RAW = np.dtype([("timestamp", "<f8"), ("value", "<f4")])
+ROLLUP = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("min", "<f4"),
+        ("max", "<f4"),
+        ("mean", "<f4"),
+        ("count", "<u4"),
+    ]
+)
+# name -> bucket seconds, finest first
+ROLLUPS = {"1s": 1, "1min": 60}
+FLUSH_INTERVAL = min(ROLLUPS.values())
+# seconds a sample may be older than the last stored one before the clock
+# is taken to have stepped back
+MAX_LATE = 1.0
+
+
+class _Rollup:
+    """Min/max/mean of the open bucket of one signal at one resolution."""
+
+    __slots__ = ("seconds", "bucket", "min", "max", "sum", "count")
+
+    def __init__(self, seconds: int) -> None:
+        self.seconds = seconds
+        self.bucket = None
+
+    def add(self, timestamps: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """Add samples in time order, returns the buckets they completed."""
+        buckets = (timestamps // self.seconds).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        sums = np.add.reduceat(values.astype(np.float64), starts)
+        counts = np.diff(np.append(starts, len(values)))
+        groups = buckets[starts]
+
+        done = np.empty(len(groups), dtype=ROLLUP)
+        n = 0
+        if self.bucket is not None:
+            if self.bucket == groups[0]:
+                mins[0] = min(mins[0], self.min)
+                maxs[0] = max(maxs[0], self.max)
+                sums[0] += self.sum
+                counts[0] += self.count
+            else:
+                done[0] = self._record(
+                    self.bucket, self.min, self.max, self.sum, self.count
+                )
+                n = 1
+        for i in range(len(groups) - 1):
+            done[n] = self._record(groups[i], mins[i], maxs[i], sums[i], counts[i])
+            n += 1
+        self.bucket = groups[-1]
+        self.min = mins[-1]
+        self.max = maxs[-1]
+        self.sum = sums[-1]
+        self.count = counts[-1]
+        return done[:n]
+
+    def close(self) -> np.ndarray:
+        done = np.empty(0 if self.bucket is None else 1, dtype=ROLLUP)
+        if self.bucket is not None:
+            done[0] = self._record(
+                self.bucket, self.min, self.max, self.sum, self.count
+            )
+            self.bucket = None
+        return done
+
+    def _record(self, bucket, minimum, maximum, total, count) -> tuple:
+        return (bucket * self.seconds, minimum, maximum, total / count, count)
+
+
+class TimeSeriesWriter:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._files = {}
+        self._rollups: Dict[str, List[Tuple[str, _Rollup]]] = {}
+        # newest stored timestamp per signal
+        self._last: Dict[str, float] = {}
+        self._flushed = time()
+        self._time_reset = False
+        self.dropped = 0
+
+    def append(self, message: str, samples: np.ndarray) -> int:
+        """Store BatchDecoder samples of one message in time order, returns
+        the sample count. NaN values (multiplexed signals not in a frame) and
+        late samples are skipped, see above."""
+        if self._time_reset:
+            self._time_reset = False
+            self._close_rollups()
+        timestamps = samples["timestamp"]
+        stored = 0
+        for name in samples.dtype.names[1:]:
+            values = samples[name]
+            signal = f"{message}.{name}"
+            present = ~np.isnan(values)
+            if not present.any():
+                continue
+            last = self._last_timestamp(signal)
+            first = timestamps[present][0]
+            if first < last - MAX_LATE:
+                self._new_segment(signal)
+            elif first <= last:
+                in_order = timestamps > last
+                self.dropped += int(np.count_nonzero(present & ~in_order))
+                present &= in_order
+                if not present.any():
+                    continue
+            records = np.empty(int(present.sum()), dtype=RAW)
+            records["timestamp"] = timestamps[present]
+            records["value"] = values[present]
+            self._last[signal] = records["timestamp"][-1]
+            self._write(signal, "raw", records)
+            for resolution, rollup in self._signal_rollups(signal):
+                done = rollup.add(records["timestamp"], records["value"])
+                if len(done):
+                    self._write(signal, resolution, done)
+            stored += len(records)
+        if time() - self._flushed >= FLUSH_INTERVAL:
+            self.flush()
+        return stored
+
+    def time_reset(self) -> None:
+        """The clock was stepped, the open rollup buckets are written out
+        with the next append instead of mixing samples of both clocks."""
+        self._time_reset = True
+
+    def flush(self) -> None:
+        for f in self._files.values():
+            f.flush()
+        self._flushed = time()
+
+    def close(self) -> None:
+        self._close_rollups()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _close_rollups(self, signals: Optional[List[str]] = None) -> None:
+        for signal in self._rollups if signals is None else signals:
+            for resolution, rollup in self._rollups.get(signal, []):
+                done = rollup.close()
+                if len(done):
+                    self._write(signal, resolution, done)
+
+    def _new_segment(self, signal: str) -> None:
+        """Move the files of a signal to the next segment directory."""
+        self._close_rollups([signal])
+        for resolution in ["raw", *ROLLUPS]:
+            f = self._files.pop((signal, resolution), None)
+            if f is not None:
+                f.close()
+        segments = os.path.join(self.root, signal, "segments")
+        os.makedirs(segments, exist_ok=True)
+        target = os.path.join(segments, str(len(_segment_dirs(self.root, signal)) - 1))
+        os.makedirs(target)
+        for resolution in ["raw", *ROLLUPS]:
+            path = _path(os.path.join(self.root, signal), resolution)
+            if os.path.exists(path):
+                os.replace(path, _path(target, resolution))
+        self._last[signal] = -np.inf
+
+    def _last_timestamp(self, signal: str) -> float:
+        last = self._last.get(signal)
+        if last is None:
+            # stored by an earlier run, maybe with a clock that was ahead
+            raw = _map(os.path.join(self.root, signal), "raw")
+            last = float(raw["timestamp"][-1]) if len(raw) else -np.inf
+            self._last[signal] = last
+        return last
+
+    def _signal_rollups(self, signal: str) -> List[Tuple[str, _Rollup]]:
+        rollups = self._rollups.get(signal)
+        if rollups is None:
+            rollups = [(name, _Rollup(s)) for name, s in ROLLUPS.items()]
+            self._rollups[signal] = rollups
+        return rollups
+
+    def _write(self, signal: str, resolution: str, records: np.ndarray) -> None:
+        f = self._files.get((signal, resolution))
+        if f is None:
+            directory = os.path.join(self.root, signal)
+            os.makedirs(directory, exist_ok=True)
+            f = open(_path(directory, resolution), "ab")
+            self._files[(signal, resolution)] = f
+        f.write(records.tobytes())
+
+
+def _path(directory: str, resolution: str) -> str:
+    return os.path.join(directory, f"{resolution}.bin")
+
+
+def _segment_dirs(root: str, signal: str) -> List[str]:
+    """The directories of a signal's segments, oldest first, the current one last."""
+    segments = os.path.join(root, signal, "segments")
+    try:
+        names = sorted(
+            (name for name in os.listdir(segments) if name.isdigit()), key=int
+        )
+    except FileNotFoundError:
+        names = []
+    return [os.path.join(segments, name) for name in names] + [
+        os.path.join(root, signal)
+    ]
+
+
+def _map(directory: str, resolution: str) -> np.ndarray:
+    """The records of one file, without a partly written last record."""
+    dtype = RAW if resolution == "raw" else ROLLUP
+    path = _path(directory, resolution)
+    try:
+        count = os.path.getsize(path) // dtype.itemsize
+    except FileNotFoundError:
+        count = 0
+    if not count:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def signals(root: str) -> List[dict]:
+    """Every stored signal with its first and last timestamp and sample count."""
+    if not os.path.isdir(root):
+        return []
+    found = []
+    for signal in sorted(os.listdir(root)):
+        raws = [_map(d, "raw") for d in _segment_dirs(root, signal)]
+        raws = [raw for raw in raws if len(raw)]
+        if not raws:
+            continue
+        found.append(
+            {
+                "signal": signal,
+                "start": min(float(raw["timestamp"][0]) for raw in raws),
+                "end": max(float(raw["timestamp"][-1]) for raw in raws),
+                "count": sum(len(raw) for raw in raws),
+            }
+        )
+    return found
+
+
+def query(
+    root: str,
+    signal: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    max_points: int = 2000,
+) -> Tuple[str, np.ndarray]:
+    """(resolution, records) of a signal between start and end, from the
+    finest resolution with at most max_points records in that range."""
+    if os.sep in signal or signal.startswith("."):
+        raise ValueError(f"invalid signal '{signal}'")
+    directories = _segment_dirs(root, signal)
+    for resolution in ["raw", *ROLLUPS]:
+        parts = []
+        for directory in directories:
+            records = _map(directory, resolution)
+            timestamps = records["timestamp"]
+            first = 0
+            last = len(records)
+            if start is not None:
+                # rollups are stamped with the start of their bucket
+                bucket = ROLLUPS.get(resolution)
+                if bucket is None:
+                    first = int(np.searchsorted(timestamps, start))
+                else:
+                    first = int(np.searchsorted(timestamps, start - bucket, "right"))
+            if end is not None:
+                last = int(np.searchsorted(timestamps, end, "right"))
+            if last > first:
+                parts.append(records[first:last])
+        count = sum(len(part) for part in parts)
+        if count <= max_points:
+            break
+    # even minutes are too many, thin them out
+    step = max(1, -(-count // max_points))
+    if not parts:
+        return resolution, np.empty(0, dtype=RAW if resolution == "raw" else ROLLUP)
+    if len(parts) == 1:
+        return resolution, np.array(parts[0][::step])
+    # segments can overlap in time
+    records = np.concatenate(parts)
+    records = records[np.argsort(records["timestamp"], kind="stable")]
+    return resolution, records[::step]
+
+
+def main():
+    parser = ArgumentParser(description="Summary of the stored time series")
+    parser.add_argument("dir", nargs="?", default=cfg.timeseries_dir)
+    args = parser.parse_args()
+
+    for info in signals(args.dir):
+        start = datetime.fromtimestamp(info["start"]).isoformat(" ", "seconds")
+        end = datetime.fromtimestamp(info["end"]).isoformat(" ", "seconds")
+        print(f"{info['signal']:<50} {start} - {end} {info['count']:>10} samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Compact vehicle data stream for the web UI ("vehicle_delta" events).
+
+vehicle_stats repeats every frame key, signal name, unit and state name in
+every update. With cfg.vehicle_stream = "delta" the decoder instead stores
+the signal schema in redis once, where server.py hands it to every client
+that asks for it ("vehicle_schema"), and updates carry only the values that
+changed since the previous update:
+
+    schema: {"version": str,
+             "signals": [[frame key, signal name, unit, {raw: state} or None]]}
+    update: {"version": str, "full": bool, "t": newest frame timestamp,
+             "i": [signal index, ...], "v": [value, ...]}
+
+Every cfg.vehicle_snapshot_interval seconds an update carries every known
+value ("full": true), so clients that joined late or missed an update
+resync. A client whose schema version differs from an update's asks for
+the schema again. With cfg.vehicle_stream_msgpack updates are sent as
+msgpack bytes instead of json.
+
+The schema covers every message in cfg.can_filter. Each subscription room
+(see subscriptions.py) gets the part of an update with its own signals.
+"""
+
+import hashlib
+import json
+from typing import Iterable, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_KEY = "vehicle_stream:schema"
+
+_UNSET = object()
+
+
+class VehicleStream:
+    def __init__(
+        self, plans: Iterable, snapshot_interval: float = 10, use_msgpack=False
+    ) -> None:
+        if use_msgpack and msgpack is None:
+            raise Exception("vehicle_stream_msgpack needs the msgpack package")
+        self.snapshot_interval = snapshot_interval
+        self.use_msgpack = use_msgpack
+        signals = []
+        for plan in plans:
+            for name, (unit, choices) in plan.signals.items():
+                signals.append([plan.key, name, unit, choices])
+        self._index = {(key, name): i for i, (key, name, _, _) in enumerate(signals)}
+        encoded = json.dumps(signals, sort_keys=True).encode()
+        self.version = hashlib.sha1(encoded).hexdigest()[:8]
+        self.schema = {"version": self.version, "signals": signals}
+        self._last = [_UNSET] * len(signals)
+        self._next_snapshot = 0.0
+
+    def indexes(self, wanted: dict) -> frozenset:
+        """Schema indexes of {frame key: signal names, or None for all}."""
+        return frozenset(
+            i
+            for (key, name), i in self._index.items()
+            if key in wanted and (wanted[key] is None or name in wanted[key])
+        )
+
+    def changes(self, decoded_batch: dict, now: float) -> Optional[dict]:
+        """The update for a vehicle_stats dict, or None if nothing changed."""
+        index = self._index
+        last = self._last
+        changed = []
+        values = []
+        newest = 0.0
+        for key, frame in decoded_batch.items():
+            if frame["timestamp"] > newest:
+                newest = frame["timestamp"]
+            for name, signal in frame["data"].items():
+                i = index.get((key, name))
+                if i is None:
+                    continue
+                value = signal["value"]
+                if last[i] is _UNSET or last[i] != value:
+                    last[i] = value
+                    changed.append(i)
+                    values.append(value)
+
+        full = now >= self._next_snapshot
+        if full:
+            self._next_snapshot = now + self.snapshot_interval
+            changed = [i for i, value in enumerate(last) if value is not _UNSET]
+            values = [last[i] for i in changed]
+        if not changed:
+            return None
+        return {
+            "version": self.version,
+            "full": full,
+            "t": newest,
+            "i": changed,
+            "v": values,
+        }
+
+    def encode(self, update: dict, indexes: frozenset = None):
+        """An update ready to emit, only with the given schema indexes, or
+        None if none of them are in it."""
+        if indexes is not None:
+            selected = [n for n, i in enumerate(update["i"]) if i in indexes]
+            if not selected:
+                return None
+            update = dict(
+                update,
+                i=[update["i"][n] for n in selected],
+                v=[update["v"][n] for n in selected],
+            )
+        if self.use_msgpack:
+            return msgpack.packb(update)
+        return update
+
+    def reset(self) -> None:
+        self._last = [_UNSET] * len(self._last)
+        self._next_snapshot = 0.0
+
+
+def load_schema(red) -> Optional[dict]:
+    schema = red.get(SCHEMA_KEY)
+    if schema is None:
+        return None
+    return json.loads(schema)
+
+
+def save_schema(red, schema: dict) -> None:
+    red.set(SCHEMA_KEY, json.dumps(schema))